@@ -5,11 +5,20 @@ from pathlib import Path
 
 from flask import Flask
 from flask_cors import CORS
+from approot.compression import init_compression
+from approot.data_managers.snapshot import init_snapshot
+from approot.data_managers.suggest import init_suggestions
+from approot.data_managers.errors import ServiceUnavailableError
 from approot.database.database import init_app
+from approot.metrics import init_metrics
 
 from approot.routes.pages import webpages
 from approot.routes.product_api import product_api as p_api
 from approot.routes.user_api import user_api as u_api
+from approot.routes.metrics_api import metrics_api as m_api
+from approot.routes.cart_api import cart_api as c_api
+from approot.routes.image_api import image_api as i_api, image_files
+from approot.utils.utils import handle_service_unavailable
 
 # Add config to the app
 from approot.importer import config
@@ -28,7 +37,16 @@ app.permanent_session_lifetime = int(flask_config['sessionLifetime'])
 app.register_blueprint(webpages)
 app.register_blueprint(p_api)
 app.register_blueprint(u_api)
-#init_app(app)
+app.register_blueprint(m_api)
+app.register_blueprint(c_api)
+app.register_blueprint(i_api)
+app.register_blueprint(image_files)
+app.register_error_handler(ServiceUnavailableError, handle_service_unavailable)  # For routes without handle_error_flask
+init_app(app)
+init_metrics(app)
+init_compression(app)
+init_snapshot(app)
+init_suggestions(app)
 
 CORS(app, supports_credentials=True)  # Allow cross-origin requests
 if __name__ == '__main__':
@@ -0,0 +1,246 @@
+"""
+Response compression.
+
+Dynamic responses (catalog JSON, rendered templates) above a size threshold are compressed with brotli or gzip,
+whichever the client prefers. Static files are served from precompressed .br/.gz siblings written by the build step:
+
+    python -m approot.compression [--force] [folder]
+"""
+import argparse
+import gzip
+import logging
+import mimetypes
+import os
+import sys
+from pathlib import Path
+
+from flask import request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from approot.importer import config
+from approot.metrics import registry
+
+try:
+    import brotli
+except ImportError:  # Optional, only gzip is offered without it
+    brotli = None
+
+COMPRESSIBLE_MIME_TYPES = {'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml',
+                           'application/xml'}
+STATIC_EXTENSIONS = {'.css', '.js', '.html', '.json', '.svg', '.txt', '.xml', '.map'}
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+compressed_bytes = registry.counter('flowers_http_compressed_bytes_total',
+                                    'Size of the compressed dynamic responses before and after compression',
+                                    ('encoding', 'stage'))
+
+
+def is_compressible(mimetype: str | None) -> bool:
+    """
+    Checks if a content type is worth compressing. Images other than SVG are already compressed
+    :param mimetype: Content type without parameters
+    :return: True if it is compressible
+    """
+    return mimetype is not None and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIME_TYPES)
+
+
+def negotiate_encoding(encodings: tuple = ENCODINGS) -> str | None:
+    """
+    Picks the encoding of the response from the Accept-Encoding header of the request
+    :param encodings: Encodings which can be used, in order of preference on equal quality
+    :return: The encoding or None if the response has to be sent uncompressed
+    """
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def etag_variants(etag: str) -> list[str]:
+    """
+    Gets every ETag a representation of the resource can be sent with. Compressed responses have their own ETag
+    (suffixed with the encoding) since they are different bytes
+    :param etag: ETag of the uncompressed response, without quotes
+    :return: list of ETags
+    """
+    return [etag] + [f"{etag}-{encoding}" for encoding in EXTENSIONS]
+
+
+def compress(data: bytes, encoding: str, level: int, brotli_level: int) -> bytes:
+    """
+    Compresses a response body
+    :param data: Body to compress
+    :param encoding: br or gzip
+    :param level: gzip compression level
+    :param brotli_level: brotli quality
+    :return: The compressed body
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_response(response, min_size: int, level: int, brotli_level: int):
+    """
+    after_request hook compressing dynamic responses. Static files, streamed responses and responses which are already
+    encoded are left as they are.
+    """
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    if response.status_code == 304:
+        return _not_modified_variant(response)
+    if response.status_code < 200 or response.status_code in (204, 206) \
+            or not is_compressible(response.mimetype):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < min_size:
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    compressed = compress(data, encoding, level, brotli_level)
+    compressed_bytes.inc(len(data), encoding=encoding, stage='in')
+    compressed_bytes.inc(len(compressed), encoding=encoding, stage='out')
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def _not_modified_variant(response):
+    """
+    Tags a 304 with the ETag of the compressed variant the client revalidated, and Vary: Accept-Encoding like the
+    variant itself. Caches only freshen a stored response with a 304 carrying its ETag
+    """
+    etag, weak = response.get_etag()
+    if etag is None:
+        return response
+    for variant in etag_variants(etag)[1:]:
+        if request.if_none_match.contains(variant):
+            response.set_etag(variant, weak)
+            response.vary.add('Accept-Encoding')
+            break
+    return response
+
+
+def _static_with_precompressed(static_view, static_folder: str):
+    """
+    Wraps the Flask static view so a fresh .br/.gz sibling written by the build step is sent instead of the file
+    when the client accepts it. Siblings older than the file are ignored.
+    """
+
+    def static(filename):
+        path = safe_join(static_folder, filename)
+        if path is None:
+            raise NotFound()
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        if is_compressible(mimetype):
+            encoding = negotiate_encoding(tuple(EXTENSIONS))
+            if encoding is not None:
+                compressed = path + EXTENSIONS[encoding]
+                try:
+                    fresh = os.stat(compressed).st_mtime >= os.stat(path).st_mtime
+                except OSError:
+                    fresh = False
+                if fresh:
+                    response = send_file(compressed, mimetype=mimetype, conditional=True)
+                    response.headers['Content-Encoding'] = encoding
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+        response = static_view(filename=filename)
+        if is_compressible(mimetype):
+            response.vary.add('Accept-Encoding')
+        return response
+
+    return static
+
+
+def init_compression(app):
+    """
+    Compression specific Flask initialization. Settings are read from the [Compression] section of config.ini
+    :param app:
+    :return:
+    """
+    compression_config = config.get_optional_config('Compression')
+    if compression_config.get('enabled', 'ENABLED') != 'ENABLED':
+        return
+
+    min_size = int(compression_config.get('minSize', '1024'))
+    level = int(compression_config.get('level', '6'))
+    brotli_level = int(compression_config.get('brotliLevel', '4'))
+    logging.debug(f"Compressing responses of at least {min_size} bytes with {', '.join(ENCODINGS)}")
+    app.after_request(lambda response: _compress_response(response, min_size, level, brotli_level))
+
+    if 'static' in app.view_functions and compression_config.get('precompressed', 'ENABLED') == 'ENABLED':
+        app.view_functions['static'] = _static_with_precompressed(app.view_functions['static'], app.static_folder)
+
+
+def build_precompressed(folder: Path, force: bool = False) -> tuple[int, int]:
+    """
+    Writes the .gz (and .br if brotli is installed) siblings of every compressible static file with the highest
+    compression level. Siblings get the modification time of their file, unchanged files are skipped.
+    :param folder: Static folder
+    :param force: Rewrite every sibling
+    :return: Number of siblings written and number of files skipped
+    """
+    written = skipped = 0
+    for path in sorted(folder.rglob('*')):
+        if not path.is_file() or path.suffix.lower() not in STATIC_EXTENSIONS:
+            continue
+
+        stat = path.stat()
+        data = None
+        for encoding in ENCODINGS:
+            target = path.with_name(path.name + EXTENSIONS[encoding])
+            if not force and target.exists() and target.stat().st_mtime_ns == stat.st_mtime_ns:
+                skipped += 1
+                continue
+
+            if data is None:
+                data = path.read_bytes()
+            compressed = compress(data, encoding, 9, 11)
+            if len(compressed) >= len(data):
+                target.unlink(missing_ok=True)
+                continue
+
+            temp = target.with_name(target.name + '.tmp')
+            temp.write_bytes(compressed)
+            os.utime(temp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            temp.replace(target)
+            written += 1
+            print(f"{path.relative_to(folder)} {len(data)} -> {len(compressed)} ({encoding})")
+    return written, skipped
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Writes precompressed .gz/.br siblings of the static files')
+    parser.add_argument('folder', nargs='?', type=Path,
+                        default=Path(__file__).parents[1] / 'webroot' / 'static')
+    parser.add_argument('--force', action='store_true', help='Rewrite siblings which are up to date')
+    args = parser.parse_args(argv)
+
+    if brotli is None:
+        print('brotli is not installed, only .gz files are written', file=sys.stderr)
+    written, skipped = build_precompressed(args.folder, args.force)
+    print(f"Wrote {written} files, {skipped} up to date")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from approot.database.database_manager import call_after_commit, in_unit_of_work
+from approot.importer import config
+from approot.metrics import registry
+
+if TYPE_CHECKING:  # The models import the images, which remember their srcsets in a QueryCache
+    from approot.database.models import Filter
+
+_MISSING = object()
+
+
+class CatalogVersion:
+    """
+    Version of the catalog, shared by every worker process on the host through the modification time of a marker file.
+    Every product write bumps it, so the caches of the other processes and the HTTP clients (ETag) notice the change.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def current(self) -> int:
+        """
+        Gets the current version. Costs one stat call
+        :return: Version, nanoseconds since the epoch of the last write
+        """
+        try:
+            return self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return self.bump()
+
+    def bump(self) -> int:
+        """
+        Creates a new version
+        :return: The new version
+        """
+        with self._lock:
+            try:
+                previous = self.path.stat().st_mtime_ns
+            except FileNotFoundError:
+                previous = 0
+                self.path.touch()
+            version = max(time.time_ns(), previous + 1)
+            os.utime(self.path, ns=(version, version))
+            return version
+
+
+class QueryCache:
+    """
+    In-process LRU cache with a TTL for query results.
+    Every worker process has its own copy. If a version function is provided the cache is dropped as soon as the
+    version changes, otherwise the TTL bounds how stale a process can get after a write in another process.
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 30.0, version=None):
+        """
+        :param int max_size: Maximum number of results to keep. 0 disables the cache
+        :param float ttl: Seconds a result stays valid
+        :param version: Optional function returning the version of the cached data, e.g. CatalogVersion.current
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self._seen_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @property
+    def generation(self) -> int:
+        """
+        Incremented on every clear. A result read before a clear must not be stored after it
+        """
+        return self._generation
+
+    def get(self, key):
+        """
+        Gets a result from the cache
+        :param key: Normalized key of the query
+        :return: The cached result or _MISSING
+        """
+        version = self.version() if self.version is not None else None
+        with self._lock:
+            if version != self._seen_version:
+                # Written by another process
+                self._entries.clear()
+                self._generation += 1
+                self._seen_version = version
+
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return _MISSING
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation: int = None):
+        """
+        Stores a result in the cache, evicting the least recently used result when full
+        :param key: Normalized key of the query
+        :param value: Result to store
+        :param int generation: Generation the result was read in. The result is dropped if the cache was cleared since
+        :return: None
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Drops one cached result
+        :param key: Normalized key of the query
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drops every cached result
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of the cache, used to size it
+        :return: dict of counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+def normalize_filters(filters: 'list[Filter] | None') -> tuple:
+    """
+    Converts a list of filters to a hashable key. The order is kept since AND/OR comparators depend on it
+    :param filters: List of filters
+    :return: tuple of filter fields
+    """
+    if not filters:
+        return tuple()
+    return tuple((_filter.field, _filter.rule, str(_filter.value), bool(_filter.negate), _filter.comparator)
+                 for _filter in filters if _filter)
+
+
+def cached_query(cache: QueryCache, key_func):
+    """
+    Decorator for serving a query from the cache. Must wrap the database_transaction_helper so hits do not use a
+    database connection.
+    :param QueryCache cache: Cache to store the results in
+    :param key_func: Function called with the arguments of the query which returns a hashable key
+    :return:
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return func(*args, **kwargs)
+
+            key = (func.__name__, key_func(*args, **kwargs))
+            value = cache.get(key)
+            if value is not _MISSING:
+                return list(value) if isinstance(value, list) else value
+
+            generation = cache.generation
+            value = func(*args, **kwargs)
+            cache.set(key, list(value) if isinstance(value, list) else value, generation)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def cached_lookup(cache: QueryCache, name: str, keys: list, fetch, key_of) -> dict:
+    """
+    Looks up several results which are cached one by one by a function decorated with cached_query.
+    Only the keys which are not cached are fetched, with one call, and the fetched results are cached for that function
+    :param QueryCache cache: Cache the single results are stored in
+    :param str name: Name of the function caching the single results, e.g. get_product_by_id
+    :param list keys: Keys to look up, as returned by the key function of that function
+    :param fetch: Function called with the list of keys which are not cached. Returns the results it found
+    :param key_of: Function returning the key of a result
+    :return: dict of key -> result for every key which was found
+    """
+    found = {}
+    if cache.enabled:
+        for key in keys:
+            value = cache.get((name, key))
+            if value is not _MISSING:
+                found[key] = value
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+        generation = cache.generation
+        for value in fetch(missing):
+            found[key_of(value)] = value
+            if cache.enabled:
+                cache.set((name, key_of(value)), value, generation)
+    return found
+
+
+def invalidates(cache: QueryCache, *versions: CatalogVersion):
+    """
+    Decorator for clearing the cache after a write. The cache is cleared even if the write fails since it might have
+    been partially applied. Inside a unit of work it is cleared again once the unit commits.
+    :param QueryCache cache: Cache to clear
+    :param CatalogVersion versions: Versions to bump once the write is committed
+    :return:
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                for version in versions:
+                    call_after_commit(version.bump)
+                if in_unit_of_work():
+                    call_after_commit(cache.clear)
+                cache.clear()
+
+        return wrapper
+
+    return decorator
+
+
+def create_cache_from_config(version: CatalogVersion = None) -> QueryCache:
+    """
+    Creates a cache with the settings of the [Cache] section of config.ini
+    :param CatalogVersion version: Version of the cached data
+    :return: QueryCache
+    """
+    cache_config = config.get_cache_config()
+    size = int(cache_config.get('size', '256')) if cache_config.get('enabled', 'ENABLED') == 'ENABLED' else 0
+    ttl = float(cache_config.get('ttl', '30'))
+    logging.debug(f"Creating query cache. Size: {size} TTL: {ttl}")
+    return QueryCache(max_size=size, ttl=ttl, version=version.current if version is not None else None)
+
+
+catalog_version = CatalogVersion(Path(config.get_cache_config().get('versionFile', '')
+                                      or Path(tempfile.gettempdir()) / 'flowers4u_catalog.version'))
+# Only bumped when product names may change (add/update/delete), not on every purchase
+catalog_names_version = CatalogVersion(catalog_version.path.with_name(f"{catalog_version.path.stem}_names.version"))
+product_cache = create_cache_from_config(catalog_version)
+
+
+def _cache_events() -> dict:
+    stats = product_cache.stats()
+    return {('product', event): stats[event] for event in ('hits', 'misses', 'evictions', 'expirations', 'invalidations')}
+
+
+registry.callback('flowers_query_cache_events_total', 'Query cache hits, misses, evictions, expirations and invalidations',
+                  _cache_events, ('cache', 'event'), metric_type='counter')
+registry.callback('flowers_query_cache_size', 'Results currently held by the query cache',
+                  lambda: {('product',): product_cache.stats()['size']}, ('cache',))
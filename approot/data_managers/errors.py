@@ -6,5 +6,25 @@ class NotFoundError(Exception):
     pass
 
 
+class CheckoutError(InvalidActionError):
+    """
+    Raised when a cart cannot be checked out. Contains the result of every line so the client can fix the cart
+    """
+
+    def __init__(self, message, lines: list[dict]):
+        super().__init__(message)
+        self.lines = lines
+
+
 class InvalidMimetypeError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class ServiceUnavailableError(Exception):
+    """
+    Raised when the server is temporarily unable to handle the request, for example when the connection pool is exhausted
+    """
+
+    def __init__(self, message, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
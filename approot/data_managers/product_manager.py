@@ -1,45 +1,131 @@
 import mariadb
 import logging
 
+from approot.data_managers.cache import product_cache, catalog_version, catalog_names_version, cached_query, \
+    cached_lookup, invalidates, normalize_filters
+from approot.data_managers.snapshot import catalog_snapshot, served_from_snapshot
+from approot.database.database import column_names, stream_rows
 from approot.database.database_manager import database_transaction_helper
-from approot.data_managers.errors import NotFoundError, InvalidActionError
-from approot.database.models import Product, Filter
-from approot.utils.utils import create_filter_query
+from approot.data_managers.errors import NotFoundError, InvalidActionError, CheckoutError
+from approot.database.models import Product, Filter, field_names
+from approot.utils.utils import compile_filter_query, compile_search_query
+
+MAX_CART_LINES = 100  # Lines of a cart bought at once
+MAX_BATCH_IDS = 100  # Products fetched at once by get_products_by_ids
+
+
+def _products_key(filters: list[Filter] = None, limit: int = 10, offset: int = 0, after: int = None,
+                  search: str = None) -> tuple:
+    """
+    Cache key of get_all_products. The offset is ignored in cursor mode, same as the query
+    """
+    return normalize_filters(filters), limit, offset if after is None else None, after, compile_search_query(search)
+
+
+def _product_key(product_id: int) -> int:
+    """
+    Cache key of get_product_by_id
+    """
+    return int(product_id)
+
+
+def _validate_quantity(quantity, allow_zero: bool = False) -> int:
+    """
+    Validates a stock quantity sent by a client. A negative quantity would turn a subtraction into an addition
+    :param quantity: Quantity to validate
+    :param bool allow_zero: Whether 0 is valid
+    :return: The quantity as an int
+    :raises InvalidActionError: If the quantity is not a valid integer
+    """
+    if isinstance(quantity, bool) or not isinstance(quantity, (int, str)):
+        raise InvalidActionError(f"Invalid quantity: '{quantity}'")
+    try:
+        quantity = int(quantity)
+    except ValueError:
+        raise InvalidActionError(f"Invalid quantity: '{quantity}'")
+    if quantity < 0 or (quantity == 0 and not allow_zero):
+        raise InvalidActionError(f"Invalid quantity: '{quantity}'")
+    return quantity
+
+
+def _check_stock_update(cursor, product_id: int, quantity: int, action: str):
+    """
+    Finds out why a conditional stock update did not change any row
+    :param cursor:
+    :param int product_id: ID of the product that was updated
+    :param int quantity: Quantity of the update
+    :param str action: Description of the action for the error message
+    :return: None if nothing had to change (quantity 0)
+    :raises NotFoundError: If no product is found with the provided ID
+    :raises mariadb.Error: If there is not enough stock
+    """
+    cursor.execute("SELECT stock FROM products WHERE product_id = ?", (product_id,))
+    if cursor.fetchone() is None:
+        raise NotFoundError(f"No product found with the provided ID. {action}")
+    if quantity > 0:
+        raise mariadb.Error("Not enough stock available")
 
 
 class ProductManager:
     """
     This class contains static methods for managing products. CRUD (just learned it)
     This moves the logic out of the API endpoints and into a separate class. The api module is now so much smaller.
+    Reads are served from product_cache when possible and every write clears it and bumps the catalog_version.
+    Product lists can also be served from the in-memory catalog_snapshot, which is refreshed on the next version.
     """
 
     @staticmethod
-    @database_transaction_helper
-    def get_all_products(filters: list[Filter] = None, limit: int = 10, offset: int = 0, cursor=None, database=None) -> list[Product]:
+    @cached_query(product_cache, _products_key)
+    @served_from_snapshot(catalog_snapshot)
+    @database_transaction_helper(prepared=True, read_only=True, dictionary=False)
+    def get_all_products(filters: list[Filter] = None, limit: int = 10, offset: int = 0, after: int = None,
+                         search: str = None, cursor=None, database=None) -> list[Product]:
         """
         Gets all products from the database based on the provided filters, limit and offset
+        If after is provided the query seeks past that product_id instead of using the offset (keyset pagination),
+        so deep pages cost the same as the first page.
+        If search is provided only the products whose name or description match it are returned, most relevant first.
+        The search uses the FULLTEXT index of approot/database/sql/002_products_fulltext.sql
         :param list[Filter] filters:
         :param int limit: Maximum number of results to return
-        :param int offset: Offset to start the query at
+        :param int offset: Offset to start the query at. Ignored if after is provided
+        :param int after: product_id of the last product of the previous page. Cannot be combined with search
+        :param str search: Words to search for in the name and description
         :param cursor:
         :param database:
-        :return: List of Product objects
+        :return: List of Product objects ordered by product_id, or by relevance when searching
         :raises NotFoundError: If no products are found which match the provided filters or limit/offset
         :raises InvalidActionError: If the provided filters are invalid
         :raises mariadb.Error: If there is an error with the database
         """
         try:
-            n_offset = limit * offset  # Calculate the offset based on the limit and offset provided
-
-            query = "SELECT * FROM products WHERE 1=1 {} LIMIT {} OFFSET {}".format(
-                create_filter_query(filters) if filters else '', limit, n_offset)
-            cursor.execute(query)
+            filter_query, params = compile_filter_query(filters)
+            search_query = compile_search_query(search)
+
+            if search_query is not None:
+                if after is not None:
+                    raise InvalidActionError("A cursor cannot be used with search, use the offset")
+                # Relevance is computed once by the select list and reused by ORDER BY
+                query = ("SELECT *, MATCH(name, description) AGAINST (? IN BOOLEAN MODE) AS relevance FROM products "
+                         "WHERE MATCH(name, description) AGAINST (? IN BOOLEAN MODE) AND (1=1 {}) "
+                         "ORDER BY relevance DESC, product_id LIMIT ? OFFSET ?").format(filter_query)
+                params = (search_query, search_query) + params + (limit, limit * offset)
+            elif after is not None:
+                # The filters are grouped so an OR filter cannot escape the seek condition
+                query = "SELECT * FROM products WHERE (1=1 {}) AND product_id > ? ORDER BY product_id LIMIT ?".format(
+                    filter_query)
+                params += (int(after), limit)
+            else:
+                n_offset = limit * offset  # Calculate the offset based on the limit and offset provided
+                query = "SELECT * FROM products WHERE 1=1 {} ORDER BY product_id LIMIT ? OFFSET ?".format(filter_query)
+                params += (limit, n_offset)
+            cursor.execute(query, params)
             data = cursor.fetchall()
 
-            if not data or all(all(not x for x in obj.values()) for obj in data):
+            if not data or all(all(not x for x in row) for row in data):
                 raise NotFoundError("No products found which match the provided filters or limit/offset")
 
-            return [Product.from_dict(product) for product in data]
+            return Product.from_rows(data, column_names(cursor))
 
         except InvalidActionError as e:
             raise e
@@ -47,6 +133,7 @@ class ProductManager:
             raise e
 
     @staticmethod
+    @invalidates(product_cache, catalog_version, catalog_names_version)
     @database_transaction_helper
     def add_product(product_data: dict, cursor=None, database=None) -> dict:
         """
@@ -70,7 +157,8 @@ class ProductManager:
             raise e
 
     @staticmethod
-    @database_transaction_helper
+    @cached_query(product_cache, _product_key)
+    @database_transaction_helper(read_only=True, dictionary=False)
     def get_product_by_id(product_id: int, cursor=None, database=None) -> Product:
         """
         Gets a product from the database by its ID
@@ -88,12 +176,64 @@ class ProductManager:
             if data is None:
                 raise NotFoundError("No product found with the provided ID. Cannot show")
 
-            return Product.from_dict(data)
+            return Product.from_row(data, column_names(cursor))
 
         except NotFoundError as e:
             raise e
 
     @staticmethod
+    def get_products_by_ids(product_ids: list[int]) -> (list[Product], list[int]):
+        """
+        Gets several products by their IDs with one query. Products already cached by get_product_by_id are not queried
+        :param list[int] product_ids: IDs of the products to get. Duplicates are ignored
+        :return: List of Product objects in the order of product_ids and the list of IDs which were not found
+        :raises InvalidActionError: If more than MAX_BATCH_IDS IDs are requested
+        :raises mariadb.Error: If there is an error with the database
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        if len(product_ids) > MAX_BATCH_IDS:
+            raise InvalidActionError(f"Cannot get more than {MAX_BATCH_IDS} products at once")
+        if not product_ids:
+            return [], []
+
+        found = cached_lookup(product_cache, 'get_product_by_id', [_product_key(product_id) for product_id in product_ids],
+                              ProductManager._fetch_products_by_ids, lambda product: product.product_id)
+        return ([found[product_id] for product_id in product_ids if product_id in found],
+                [product_id for product_id in product_ids if product_id not in found])
+
+    @staticmethod
+    @database_transaction_helper(read_only=True, dictionary=False)
+    def _fetch_products_by_ids(product_ids: list[int], cursor=None, database=None) -> list[Product]:
+        """
+        Gets the products with the provided IDs from the database
+        :param list[int] product_ids: IDs of the products to get
+        :param cursor:
+        :param database:
+        :return: List of Product objects, in no particular order. IDs which do not exist are left out
+        :raises mariadb.Error: If there is an error with the database
+        """
+        placeholders = ', '.join('?' * len(product_ids))
+        cursor.execute(f"SELECT * FROM products WHERE product_id IN ({placeholders})", tuple(product_ids))
+        return Product.from_rows(cursor.fetchall(), column_names(cursor))
+
+    @staticmethod
+    def export_products(batch_size: int = 1000):
+        """
+        Streams every product, ordered by product_id, for the catalog export. The rows are read with an unbuffered
+        cursor on a connection of its own, so the memory used does not depend on the size of the catalog.
+        Not cached since the export is read once. The generator must be exhausted or closed to return the connection.
+        :param int batch_size: Number of products fetched from the server at once
+        :return: Generator of lists of Product objects
+        :raises ServiceUnavailableError: If no database connection is free
+        :raises mariadb.Error: If there is an error with the database
+        """
+        columns = field_names(Product)
+        query = "SELECT {} FROM products ORDER BY product_id".format(', '.join(columns))
+        for rows in stream_rows(query, batch_size=batch_size, dictionary=False):
+            yield Product.from_rows(rows, columns)
+
+    @staticmethod
+    @invalidates(product_cache, catalog_version, catalog_names_version)
     @database_transaction_helper
     def update_product(product_id: int, product_data: dict, cursor=None, database=None) -> dict:
         """
@@ -124,6 +264,7 @@ class ProductManager:
             raise e
 
     @staticmethod
+    @invalidates(product_cache, catalog_version, catalog_names_version)
     @database_transaction_helper
     def delete_product(product_id: int, cursor=None, database=None) -> dict:
         """
@@ -150,6 +291,7 @@ class ProductManager:
             raise e
 
     @staticmethod
+    @invalidates(product_cache, catalog_version)
     @database_transaction_helper
     def update_product_stock(product_id: int, data: dict, cursor=None, database=None) -> dict:
         """
@@ -164,25 +306,22 @@ class ProductManager:
         :raises mariadb.Error: If there is an error with the database
         """
         try:
-            cursor.execute("SELECT * FROM products WHERE product_id = ?", (product_id,))
-            product = cursor.fetchone()
-
-            if not product:
-                raise NotFoundError("No product found with the provided ID. Cannot update stock")
-
-            quantity = data.get('quantity', 0)
+            quantity = _validate_quantity(data.get('quantity', 0), allow_zero=True)
 
             if data['action'] == 'add':
                 cursor.execute("UPDATE products SET stock = stock + ? WHERE product_id = ?",
                                (quantity, product_id))
             elif data['action'] == 'subtract':
-                if product['stock'] < data['quantity']:
-                    raise mariadb.Error("Not enough stock available")
-                cursor.execute("UPDATE products SET stock = stock - ? WHERE product_id = ?",
-                               (quantity, product_id))
+                # Checked and decremented in one statement so no lock is held between a read and the update
+                cursor.execute("UPDATE products SET stock = stock - ? WHERE product_id = ? AND stock >= ?",
+                               (quantity, product_id, quantity))
             else:
                 raise InvalidActionError(f"Invalid action: '{data['action']}'")
 
+            if cursor.rowcount == 0:
+                # Nothing changed. Either the product does not exist, there is not enough stock or the quantity was 0
+                _check_stock_update(cursor, product_id, quantity, "Cannot update stock")
+
             database.commit()
             return dict()
 
@@ -192,6 +331,7 @@ class ProductManager:
             raise e
 
     @staticmethod
+    @invalidates(product_cache, catalog_version)
     @database_transaction_helper
     def buy_product(product_id: int, data: dict, cursor=None, database=None) -> dict:
         """
@@ -202,24 +342,85 @@ class ProductManager:
         :param database:
         :return: Empty dict
         :raises NotFoundError: If no product is found with the provided ID
-        :raises mariadb.Error: If there is an error with the database
+        :raises InvalidActionError: If the quantity is not a positive integer
+        :raises mariadb.Error: If there is an error with the database or not enough stock is available
         """
         try:
-            cursor.execute("SELECT stock FROM products WHERE product_id = ? FOR UPDATE", (product_id,))
-
-            product = cursor.fetchone()
-            if product is None:
-                raise NotFoundError("No product found with the provided ID. Cannot buy")
-
-            current_stock = product['stock']
+            quantity = _validate_quantity(data.get('quantity', 1))
 
-            quantity = data.get('quantity', 1)
-            if current_stock < quantity:
-                raise mariadb.Error("Not enough stock available")
+            # Checked and decremented in one statement. The row lock is only held for this statement instead of
+            # across a SELECT ... FOR UPDATE round trip, so buyers of the same product queue for much less time
+            cursor.execute("UPDATE products SET stock = stock - ? WHERE product_id = ? AND stock >= ?",
+                           (quantity, product_id, quantity))
+            if cursor.rowcount == 0:
+                _check_stock_update(cursor, product_id, quantity, "Cannot buy")
 
-            cursor.execute("UPDATE products SET stock = stock - ? WHERE product_id = ?", (quantity, product_id))
             database.commit()
 
             return dict()
+        except InvalidActionError as e:
+            raise e
         except NotFoundError as e:
             raise e
+
+    @staticmethod
+    @invalidates(product_cache, catalog_version)
+    @database_transaction_helper
+    def buy_products(items: list[dict], cursor=None, database=None) -> list[dict]:
+        """
+        'Buys' every product of a cart in one transaction. Either every line is bought or none is.
+        The rows are locked in product_id order so two carts with the same products cannot deadlock.
+        :param list[dict] items: Lines of the cart, each a dict containing product_id and quantity.
+            Lines for the same product are merged
+        :param cursor:
+        :param database:
+        :return: List containing the result of every line: product_id, quantity and status "ok"
+        :raises CheckoutError: If a product does not exist or does not have enough stock. Contains the result of every
+            line, the status of a failed line is "not_found" or "insufficient_stock"
+        :raises InvalidActionError: If the cart is empty, too large or contains an invalid line
+        :raises mariadb.Error: If there is an error with the database
+        """
+        try:
+            if not isinstance(items, list):
+                raise InvalidActionError("The items must be an array of cart lines")
+            if not items:
+                raise InvalidActionError("The cart is empty")
+            if len(items) > MAX_CART_LINES:
+                raise InvalidActionError(f"The cart cannot contain more than {MAX_CART_LINES} lines")
+
+            quantities = {}  # product_id -> quantity, in the order of the cart
+            for item in items:
+                try:
+                    product_id = int(item['product_id'])
+                except (KeyError, TypeError, ValueError):
+                    raise InvalidActionError(f"Invalid cart line: '{item}'")
+                quantities[product_id] = quantities.get(product_id, 0) + _validate_quantity(item.get('quantity', 1))
+
+            product_ids = sorted(quantities)
+            placeholders = ', '.join('?' * len(product_ids))
+            cursor.execute(f"SELECT product_id, stock FROM products WHERE product_id IN ({placeholders})"
+                           f" ORDER BY product_id FOR UPDATE", tuple(product_ids))
+            # NULL stock is out of stock, like the stock filter treats it
+            stock = {row['product_id']: row['stock'] or 0 for row in cursor.fetchall()}
+
+            lines = []
+            for product_id, quantity in quantities.items():
+                line = {'product_id': product_id, 'quantity': quantity, 'status': 'ok'}
+                if product_id not in stock:
+                    line['status'] = 'not_found'
+                elif stock[product_id] < quantity:
+                    line['status'] = 'insufficient_stock'
+                    line['available'] = stock[product_id]
+                lines.append(line)
+
+            if any(line['status'] != 'ok' for line in lines):
+                database.rollback()
+                raise CheckoutError("Some products of the cart cannot be bought", lines)
+
+            cursor.executemany("UPDATE products SET stock = stock - ? WHERE product_id = ?",
+                               [(quantities[product_id], product_id) for product_id in product_ids])
+            database.commit()
+
+            return lines
+        except InvalidActionError as e:
+            raise e
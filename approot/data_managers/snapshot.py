@@ -0,0 +1,349 @@
+import logging
+import threading
+import time
+from functools import wraps
+
+import mariadb
+
+from approot.data_managers.cache import CatalogVersion, catalog_version
+from approot.data_managers.errors import NotFoundError
+from approot.database.database import column_names
+from approot.database.database_manager import database_transaction_helper, in_unit_of_work
+from approot.database.models import Filter, Product
+from approot.importer import config
+from approot.metrics import registry
+from approot.utils.utils import compile_filter_query
+
+try:
+    import numpy as np
+except ImportError:  # Optional, the snapshot stays disabled without it
+    np = None
+
+snapshot_refreshes = registry.counter('flowers_catalog_snapshot_refreshes_total',
+                                      'Refreshes of the in-memory catalog snapshot', ('kind',))
+
+
+class _Columns:
+    """
+    Immutable column arrays of the catalog, ordered by product_id. Replaced as a whole on every refresh so queries
+    never see a half updated snapshot
+    """
+
+    def __init__(self, products: list[Product]):
+        self.products = sorted(products, key=lambda product: product.product_id)
+        count = len(self.products)
+        self.ids = np.fromiter((product.product_id for product in self.products), dtype=np.int64, count=count)
+        self.prices, self.price_valid = self._column([product.price for product in self.products])
+        self.stocks, self.stock_valid = self._column([product.stock for product in self.products])
+
+        # Name index: every name casefolded and joined in one string, a contains filter is a few str.find calls
+        names = [(product.name or '').casefold() for product in self.products]
+        self.name_valid = np.fromiter((product.name is not None for product in self.products), dtype=bool, count=count)
+        self.name_blob = '\0'.join(names)
+        self.name_starts = np.zeros(count, dtype=np.int64)
+        if count:
+            self.name_starts[1:] = np.cumsum(np.fromiter((len(name) + 1 for name in names[:-1]), dtype=np.int64,
+                                                         count=count - 1))
+
+    @staticmethod
+    def _column(values: list) -> tuple:
+        valid = np.fromiter((value is not None for value in values), dtype=bool, count=len(values))
+        column = np.fromiter((value or 0 for value in values), dtype=np.float64, count=len(values))
+        return column, valid
+
+    def name_contains(self, value: str):
+        """
+        Matches the names containing the value, case-insensitively like the default collation of MariaDB
+        """
+        value = value.casefold()
+        mask = np.zeros(len(self.ids), dtype=bool)
+        if '\0' in value:
+            return mask
+        if not value:
+            return self.name_valid.copy()
+
+        position = self.name_blob.find(value)
+        while position != -1:
+            row = int(np.searchsorted(self.name_starts, position, side='right')) - 1
+            mask[row] = True
+            # Continue with the next name, one match per name is enough
+            next_start = self.name_starts[row + 1] if row + 1 < len(self.name_starts) else len(self.name_blob)
+            position = self.name_blob.find(value, int(next_start))
+        return mask
+
+
+class CatalogSnapshot:
+    """
+    In-memory copy of the products table in NumPy column arrays, serving get_all_products without the database.
+    Filters are evaluated as vectorized boolean masks with the precedence of the SQL they replace (AND before OR).
+
+    The snapshot is refreshed when the catalog version changes. If the table has an updated_at column only the rows
+    changed since the last refresh are read, otherwise the table is read again. One request refreshes it, meanwhile the
+    others read the database. Every checkInterval seconds, and when a new version changed no row, the row count, highest
+    product_id and stock sum are compared with MariaDB. A mismatch, e.g. a delete or a write from outside the
+    application, reloads the whole table.
+    """
+
+    def __init__(self, version: CatalogVersion, check_interval: float = 30.0, watermark_overlap: float = 5.0,
+                 enabled: bool = True):
+        """
+        :param CatalogVersion version: Version of the catalog
+        :param float check_interval: Seconds between consistency checks
+        :param float watermark_overlap: Seconds rows are read again before the updated_at watermark, so rows of
+            transactions which committed late are not missed
+        :param bool enabled: Whether the snapshot serves queries
+        """
+        self.version = version
+        self.check_interval = check_interval
+        self.watermark_overlap = watermark_overlap
+        self.enabled = enabled and np is not None
+        self._columns = None
+        self._seen_version = None
+        self._has_updated_at = False
+        self._watermark = None  # Highest updated_at seen, compared in the time zone of the database
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        columns = self._columns
+        return len(columns.products) if columns is not None else 0
+
+    def get_all_products(self, filters: list[Filter] = None, limit: int = 10, offset: int = 0,
+                         after: int = None, search: str = None) -> list[Product] | None:
+        """
+        Same as ProductManager.get_all_products, from memory. Searches are left to the FULLTEXT index
+        :return: List of Product objects ordered by product_id or None if the snapshot cannot answer the query
+        :raises NotFoundError: If no products are found which match the provided filters or limit/offset
+        :raises InvalidActionError: If the provided filters are invalid
+        """
+        if search:
+            return None
+        compile_filter_query(filters)  # Validates the filters like the query would
+        try:
+            columns = self.current()
+        except mariadb.Error as e:
+            logging.error(f"Failed to refresh the catalog snapshot: {e}")
+            return None
+        if columns is None:
+            return None  # Being refreshed by another request
+
+        mask = self._evaluate(columns, filters)
+        if mask is None:
+            return None
+        if after is not None:
+            mask &= columns.ids > int(after)
+            start = 0
+        else:
+            start = limit * offset
+
+        rows = np.flatnonzero(mask)[start:start + limit]
+        if not len(rows):
+            raise NotFoundError("No products found which match the provided filters or limit/offset")
+        return [columns.products[row] for row in rows]
+
+    @staticmethod
+    def _evaluate(columns: _Columns, filters: list[Filter] | None):
+        """
+        Evaluates the filters as the WHERE clause 1=1 <comparator> [NOT] <filter> ... would be.
+        AND binds tighter than OR, so the filters are split into OR groups of AND terms
+        :return: Boolean mask of the matching rows or None if a value cannot be compared in memory
+        """
+        result = np.zeros(len(columns.ids), dtype=bool)
+        group = np.ones(len(columns.ids), dtype=bool)  # 1=1
+        for _filter in filters or []:
+            if not _filter:
+                continue
+            if _filter.field == 'name':
+                valid, match = columns.name_valid, columns.name_contains(str(_filter.value))
+            else:
+                column, valid = (columns.prices, columns.price_valid) if _filter.field == 'price' \
+                    else (columns.stocks, columns.stock_valid)
+                if _filter.rule == 'exists':
+                    match = column > 0
+                else:
+                    try:
+                        value = float(_filter.value)
+                    except (TypeError, ValueError):
+                        return None  # MariaDB casts it, leave it to the query
+                    match = {'equals': column == value, 'greater': column > value, 'less': column < value}[_filter.rule]
+
+            # Comparisons with NULL are never true, negated or not
+            term = valid & (~match if _filter.negate else match)
+            if _filter.comparator == 'OR':
+                result |= group
+                group = term
+            else:
+                group = group & term
+        return result | group
+
+    def current(self) -> _Columns | None:
+        """
+        Gets the columns, refreshing them first if the catalog changed or the consistency check is due. Only one thread
+        refreshes them, the others do not wait: they get the previous columns if only the check is due, or None if the
+        catalog changed, as the previous columns are older than the version the response is tagged with
+        :return: The columns or None while another thread refreshes them after a change
+        """
+        # The refresh replaces the columns before the version, so columns read after a version are at least as new
+        seen_version = self._seen_version
+        columns = self._columns
+        version = self.version.current()
+        if columns is not None and version == seen_version and time.monotonic() - self._checked < self.check_interval:
+            return columns
+
+        if columns is None:
+            self._lock.acquire()  # Nothing to serve before the first load
+        elif not self._lock.acquire(blocking=False):
+            return columns if version == seen_version else None
+        try:
+            version = self.version.current()
+            if self._columns is None:
+                self._reload(version)
+            elif version != self._seen_version or time.monotonic() - self._checked >= self.check_interval:
+                self._refresh(version)
+            return self._columns
+        finally:
+            self._lock.release()
+
+    def _reload(self, version: int):
+        started = time.perf_counter()
+        rows, columns = self._fetch_products()
+        self._columns = _Columns(Product.from_rows(rows, columns))
+        self._has_updated_at = 'updated_at' in columns
+        self._watermark = self._max_updated_at(rows, columns)
+        self._seen_version = version
+        self._checked = time.monotonic()
+        snapshot_refreshes.inc(kind='full')
+        logging.info(f"Loaded {len(rows)} products into the catalog snapshot in "
+                     f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def _refresh(self, version: int):
+        check_due = time.monotonic() - self._checked >= self.check_interval
+        if not self._has_updated_at or self._watermark is None:
+            if version != self._seen_version:
+                self._reload(version)  # Nothing tells which rows changed
+                return
+        else:
+            rows, columns = self._fetch_changed_products(self._watermark, int(self.watermark_overlap * 1_000_000))
+            if rows:
+                products = {product.product_id: product for product in self._columns.products}
+                for product in Product.from_rows(rows, columns):
+                    products[product.product_id] = product
+                self._columns = _Columns(list(products.values()))
+                self._watermark = max(self._watermark, self._max_updated_at(rows, columns))
+            elif version != self._seen_version:
+                check_due = True  # The change is not visible in updated_at, e.g. a delete
+            snapshot_refreshes.inc(kind='incremental')
+
+        if not check_due:
+            self._seen_version = version
+            return
+        if not self._consistent():
+            logging.warning("Catalog snapshot is out of sync with the database, reloading it")
+            snapshot_refreshes.inc(kind='mismatch')
+            self._reload(version)
+            return
+        self._seen_version = version
+        self._checked = time.monotonic()
+
+    @staticmethod
+    def _max_updated_at(rows: list[tuple], columns: tuple):
+        if 'updated_at' not in columns:
+            return None
+        updated_at = columns.index('updated_at')
+        return max((row[updated_at] for row in rows), default=None)
+
+    def _consistent(self) -> bool:
+        count, max_id, stock = self._fetch_checksums()
+        columns = self._columns
+        return (count == len(columns.ids)
+                and max_id == (int(columns.ids[-1]) if len(columns.ids) else 0)
+                and stock == int(columns.stocks[columns.stock_valid].sum()))
+
+    @staticmethod
+    @database_transaction_helper(read_only=True, primary=True, dictionary=False)
+    def _fetch_products(cursor=None, database=None) -> (list[tuple], tuple):
+        """
+        Reads the whole products table
+        :return: The rows and their column names
+        """
+        cursor.execute("SELECT * FROM products")
+        return cursor.fetchall(), column_names(cursor)
+
+    @staticmethod
+    @database_transaction_helper(read_only=True, primary=True, dictionary=False)
+    def _fetch_changed_products(watermark, overlap: int, cursor=None, database=None) -> (list[tuple], tuple):
+        """
+        Reads the products changed since the watermark. Deleted products are found by the consistency check
+        :param watermark: Highest updated_at of the snapshot, as returned by the database
+        :param int overlap: Microseconds read again before the watermark
+        """
+        cursor.execute("SELECT * FROM products WHERE updated_at >= ? - INTERVAL ? MICROSECOND", (watermark, overlap))
+        return cursor.fetchall(), column_names(cursor)
+
+    @staticmethod
+    @database_transaction_helper(read_only=True, primary=True, dictionary=False)
+    def _fetch_checksums(cursor=None, database=None) -> (int, int, int):
+        cursor.execute("SELECT COUNT(*), COALESCE(MAX(product_id), 0), COALESCE(SUM(stock), 0) FROM products")
+        count, max_id, stock = cursor.fetchone()
+        return int(count), int(max_id), int(stock)
+
+
+def served_from_snapshot(snapshot: CatalogSnapshot):
+    """
+    Decorator for serving a query from the snapshot when it is enabled. Must wrap the database_transaction_helper so
+    queries answered by the snapshot do not use a database connection. Units of work always read the database.
+    :param CatalogSnapshot snapshot: Snapshot with a method of the same name as the decorated function
+    :return:
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if snapshot.enabled and not in_unit_of_work():
+                result = getattr(snapshot, func.__name__)(*args, **kwargs)
+                if result is not None:
+                    return result
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def create_snapshot_from_config(version: CatalogVersion) -> CatalogSnapshot:
+    """
+    Creates the snapshot with the settings of the [Snapshot] section of config.ini
+    :param CatalogVersion version: Version of the catalog
+    :return: CatalogSnapshot
+    """
+    snapshot_config = config.get_optional_config('Snapshot')
+    enabled = snapshot_config.get('enabled', 'DISABLED') == 'ENABLED'
+    if enabled and np is None:
+        logging.warning("The catalog snapshot requires numpy, it stays disabled")
+    return CatalogSnapshot(version,
+                           check_interval=float(snapshot_config.get('checkInterval', '30')),
+                           watermark_overlap=float(snapshot_config.get('watermarkOverlap', '5')),
+                           enabled=enabled)
+
+
+catalog_snapshot = create_snapshot_from_config(catalog_version)
+
+registry.callback('flowers_catalog_snapshot_products', 'Products held by the in-memory catalog snapshot',
+                  lambda: {(): catalog_snapshot.size})
+
+
+def init_snapshot(app):
+    """
+    Snapshot specific Flask initialization. Loads the snapshot at startup so the first request does not wait for it
+    :param app:
+    :return:
+    """
+    if not catalog_snapshot.enabled:
+        return
+    with app.app_context():
+        try:
+            catalog_snapshot.current()
+        except mariadb.Error as e:
+            # Loaded by the first query instead
+            logging.error(f"Failed to load the catalog snapshot: {e}")
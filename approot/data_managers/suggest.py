@@ -0,0 +1,148 @@
+import bisect
+import logging
+import re
+import threading
+import time
+
+import mariadb
+
+from approot.data_managers.cache import CatalogVersion, catalog_names_version
+from approot.database.database_manager import database_transaction_helper
+from approot.metrics import registry
+
+WORD = re.compile(r'\w+')
+MAX_SCANNED = 2000  # Index entries looked at for one prefix, bounds the latency of very short prefixes
+
+suggestion_rebuilds = registry.counter('flowers_suggestion_index_rebuilds_total',
+                                       'Rebuilds of the product name suggestion index')
+
+
+class _Index:
+    """
+    Immutable sorted array of (key, product_id) entries. Every product has an entry for its whole name and one for
+    every word of its name after the first, so a prefix matches the start of any word
+    """
+
+    def __init__(self, products: list[tuple[int, str]]):
+        self.names = {}
+        entries = []
+        for product_id, name in products:
+            if not name:
+                continue
+            self.names[product_id] = name
+            folded = name.casefold()
+            entries.append((folded, product_id))
+            for word in WORD.finditer(folded):
+                if word.start() > 0:
+                    entries.append((folded[word.start():], product_id))
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.product_ids = [product_id for _, product_id in entries]
+
+
+class SuggestionIndex:
+    """
+    In-memory prefix index of the product names for the type-ahead suggestions. Looking up a prefix is a binary search
+    in a sorted array followed by a short scan, so it does not depend on the size of the catalog.
+    The index is built at startup and rebuilt when the names version changes, i.e. after a product is added, updated or
+    deleted by any worker process. Purchases do not touch it.
+    """
+
+    def __init__(self, version: CatalogVersion):
+        self.version = version
+        self._index = None
+        self._seen_version = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        index = self._index
+        return len(index.names) if index is not None else 0
+
+    def suggest(self, prefix: str, limit: int = 10) -> list[dict]:
+        """
+        Gets the names starting with the prefix, or with a word starting with the prefix.
+        Names starting with the prefix come first, then the names whose other words match, alphabetically
+        :param str prefix: What the user typed so far
+        :param int limit: Maximum number of suggestions
+        :return: list of {"product_id": ..., "name": ...}
+        :raises mariadb.Error: If the index has to be built and the database fails
+        """
+        index = self.current()
+        prefix = ' '.join(prefix.casefold().split())
+        if not prefix or limit <= 0:
+            return []
+
+        start = bisect.bisect_left(index.keys, prefix)
+        end = min(start + MAX_SCANNED, len(index.keys))
+        name_matches, word_matches, seen = [], [], set()
+        for position in range(start, end):
+            if not index.keys[position].startswith(prefix):
+                break
+            product_id = index.product_ids[position]
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+            name = index.names[product_id]
+            (name_matches if name.casefold().startswith(prefix) else word_matches).append((name.casefold(), product_id))
+            if len(name_matches) >= limit:
+                break
+
+        matches = sorted(name_matches)[:limit]
+        matches += sorted(word_matches)[:limit - len(matches)]
+        return [{'product_id': product_id, 'name': index.names[product_id]} for _, product_id in matches]
+
+    def current(self) -> _Index:
+        """
+        Gets the index, rebuilding it first if the names changed. While one thread rebuilds the others keep using the
+        previous index
+        :return:
+        """
+        version = self.version.current()
+        if self._index is not None and version == self._seen_version:
+            return self._index
+
+        if not self._lock.acquire(blocking=self._index is None):
+            return self._index
+        try:
+            version = self.version.current()
+            if self._index is None or version != self._seen_version:
+                started = time.perf_counter()
+                self._index = _Index(self._fetch_names())
+                self._seen_version = version
+                suggestion_rebuilds.inc()
+                logging.info(f"Built the suggestion index of {self.size} products in "
+                             f"{(time.perf_counter() - started) * 1000:.0f} ms")
+            return self._index
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    @database_transaction_helper(read_only=True, primary=True, dictionary=False)
+    def _fetch_names(cursor=None, database=None) -> list[tuple[int, str]]:
+        """
+        Reads the names from the primary. The index is tagged with the version it was built after, a lagging replica
+        could miss a product which was just added or renamed until the names change again
+        """
+        cursor.execute("SELECT product_id, name FROM products")
+        return cursor.fetchall()
+
+
+suggestion_index = SuggestionIndex(catalog_names_version)
+
+registry.callback('flowers_suggestion_index_products', 'Products held by the name suggestion index',
+                  lambda: {(): suggestion_index.size})
+
+
+def init_suggestions(app):
+    """
+    Suggestion specific Flask initialization. Builds the index at startup so the first keystroke does not wait for it
+    :param app:
+    :return:
+    """
+    with app.app_context():
+        try:
+            suggestion_index.current()
+        except mariadb.Error as e:
+            # Built by the first request instead
+            logging.error(f"Failed to build the suggestion index: {e}")
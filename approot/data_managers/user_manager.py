@@ -14,7 +14,7 @@ class UserManager:
     """
 
     @staticmethod
-    @database_transaction_helper
+    @database_transaction_helper(read_only=True)
     def get_user_by_id(user_id: int, cursor=None, database=None) -> User:
         """
         Gets a user from the database by their id
@@ -34,7 +34,7 @@ class UserManager:
             raise e
 
     @staticmethod
-    @database_transaction_helper
+    @database_transaction_helper(read_only=True, primary=True)
     def login(username: str, password: str, cursor=None, database=None) -> User:
         """
         Logs a user in by checking the provided credentials against the database
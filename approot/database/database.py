@@ -1,11 +1,20 @@
 from pathlib import Path
 
+import configparser
 import flask.logging
 import mariadb
 import logging
+import math
 import importlib.util
+import itertools
+import os
+import threading
+import time
 
-from flask import g
+from flask import g, current_app, has_app_context, has_request_context, request
+
+from approot.data_managers.errors import ServiceUnavailableError
+from approot.metrics import registry
 
 config_path = Path(__file__).parent.parent.parent / 'config'
 spec = importlib.util.spec_from_file_location('config', config_path / 'config.py')
@@ -16,18 +25,100 @@ logging.getLogger(__name__)
 
 # Global variable for the connection pool
 pool: mariadb.ConnectionPool = None  # type: ignore
+POOL_NAME = "FlowerPool"
+_pool_lock = threading.Lock()
+_inherited_pools = []  # Pools created before a fork. Kept referenced so the child never closes the parent's sockets
+checkout_timeout = 2.0  # Seconds a request waits for a free connection before giving up with a 503
+retry_after = 1  # Seconds sent in the Retry-After header when the pool is exhausted
+read_your_writes_window = 5.0  # Seconds a client reads from the primary after it wrote
+LAST_WRITE_COOKIE = 'db_last_write'
+replica_eject_time = 30.0  # Seconds a failing replica is taken out of the rotation
+stream_write_timeout = 600  # Seconds the server waits for a slow client reading a streamed result
+# Streamed results running at once. Each holds a connection as long as its client reads, slow clients must not be able
+# to take the whole pool
+stream_slots = threading.BoundedSemaphore(2)
 
+# Pool instrumentation
+pool_checkout_wait = registry.histogram('flowers_db_pool_checkout_wait_seconds',
+                                        'Time spent waiting for a connection from the pool', ('pool',))
+pool_checkout_duration = registry.histogram('flowers_db_pool_checkout_duration_seconds',
+                                            'Time a connection stayed checked out of the pool', ('pool',))
+pool_active_connections = registry.gauge('flowers_db_pool_active_connections',
+                                         'Connections currently checked out of the pool', ('pool',))
+pool_exhausted = registry.counter('flowers_db_pool_exhausted_total',
+                                  'Checkouts that failed because the pool had no free connection', ('pool',))
+pool_reconnects = registry.counter('flowers_db_pool_reconnects_total',
+                                   'Pooled connections that were transparently reconnected', ('pool',))
+replica_ejections = registry.counter('flowers_db_replica_ejections_total',
+                                     'Times a replica was taken out of the rotation after a failure', ('pool',))
+_connection_ids = {}  # id() of a pooled connection -> server connection id seen when it was last returned
+_connection_ids_lock = threading.Lock()
 
-def init_connection_pool(debug=False):
+
+class ReplicaPool:
+    """
+    Connection pool of a read replica. A replica which fails is ejected from the rotation for replica_eject_time
+    seconds and is pinged before it is used again.
+    """
+
+    def __init__(self, name: str, database_config, debug=False):
+        self.name = name
+        self.database_config = database_config
+        self.debug = debug
+        self.pool: mariadb.ConnectionPool | None = None
+        self.ejected_until = 0.0
+        self.ejected = False
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def connect(self):
+        """
+        Creates the pool of the replica if it does not exist yet
+        :return: None
+        :raises mariadb.Error: If the replica cannot be reached
+        """
+        if self.pool is None:
+            self.pool = mariadb.ConnectionPool(pool_name=self.name, **_pool_arguments(self.database_config, self.debug))
+            self.pool.auto_reconnect = self.database_config.get('reconnect', 'ENABLED') == 'ENABLED'
+            pool_exhausted.inc(0, pool=self.name)
+            pool_reconnects.inc(0, pool=self.name)
+
+    def eject(self, error):
+        """
+        Takes the replica out of the rotation
+        :param error: Reason of the ejection
+        :return: None
+        """
+        logging.error(f"Ejecting replica {self.name} for {replica_eject_time}s: {error}")
+        self.ejected_until = time.monotonic() + replica_eject_time
+        self.ejected = True
+        replica_ejections.inc(pool=self.name)
+
+
+# Read replicas, empty if none are configured
+replica_pools: list[ReplicaPool] = []
+_replica_counter = itertools.count()
+
+
+def _idle_connections() -> dict:
+    pools = [(POOL_NAME, pool)] + [(replica.name, replica.pool) for replica in replica_pools]
+    return {(name, ): max(_pool.pool_size - pool_active_connections.get(pool=name), 0)
+            for name, _pool in pools if _pool}
+
+
+registry.callback('flowers_db_pool_idle_connections', 'Connections waiting in the pool', _idle_connections, ('pool',))
+
+
+def _pool_arguments(database_config, debug=False) -> dict:
     """
-    Initializes the connection pool
+    Creates the connection arguments of a pool from a config section
+    :param database_config: [Database] or [DatabaseReplica...] section
     :param debug:
-    :return:
+    :return: dict of mariadb.ConnectionPool keyword arguments
     """
-    global pool
-    database_config = config.get_database_config()
-    pool = mariadb.ConnectionPool(
-        pool_name="FlowerPool",
+    return dict(
         pool_size=int(database_config['poolSize']),
         host=database_config['host'],
         user=database_config['user'],
@@ -44,7 +135,118 @@ def init_connection_pool(debug=False):
         ssl_verify_cert=debug,
         # ssl=database_config['ssl'] == 'ENABLED',
     )
+
+
+def init_connection_pool(debug=False):
+    """
+    Initializes the connection pool and the replica pools
+    Use ensure_connection_pool instead to avoid initializing the pool twice from different threads
+    :param debug:
+    :return:
+    """
+    global pool, checkout_timeout, retry_after, read_your_writes_window, replica_eject_time, stream_write_timeout, \
+        stream_slots
+    database_config = config.get_database_config()
+    checkout_timeout = int(database_config.get('checkoutTimeout', '2000')) / 1000
+    retry_after = int(database_config.get('retryAfter', '1'))
+    read_your_writes_window = float(database_config.get('readYourWritesWindow', '5'))
+    replica_eject_time = float(database_config.get('replicaEjectTime', '30'))
+    stream_write_timeout = int(database_config.get('streamWriteTimeout', '600'))
+    stream_slots = threading.BoundedSemaphore(int(database_config.get('maxStreams', '2')))
+    pool = mariadb.ConnectionPool(pool_name=POOL_NAME, **_pool_arguments(database_config, debug))
     pool.auto_reconnect = database_config['reconnect'] == 'ENABLED'
+    # Export the counters as 0 before the first event
+    pool_exhausted.inc(0, pool=POOL_NAME)
+    pool_reconnects.inc(0, pool=POOL_NAME)
+
+    replica_pools.clear()
+    for name, replica_config in config.get_replica_configs():
+        # Keys missing from the replica section are taken from [Database]
+        merged_config = configparser.ConfigParser(interpolation=None)
+        merged_config.read_dict({name: {**database_config, **replica_config}})
+        replica = ReplicaPool(name, merged_config[name], debug)
+        try:
+            replica.connect()
+        except mariadb.Error as e:
+            replica.eject(e)
+        replica_pools.append(replica)
+
+
+def ensure_connection_pool(debug=False):
+    """
+    Initializes the connection pool if it does not exist yet. Safe to call from several threads
+    :param debug:
+    :return: None
+    """
+    if pool:
+        return
+    with _pool_lock:
+        if not pool:
+            init_connection_pool(debug)
+
+
+def warm_up_pool(debug=False):
+    """
+    Initializes the pools and checks every connection out once so the connect and TLS handshake cost is paid
+    before the first request instead of during it
+    :param debug:
+    :return: None
+    """
+    ensure_connection_pool(debug)
+    _warm_up(pool, POOL_NAME)
+    for replica in replica_pools:
+        if replica.pool is not None:
+            try:
+                _warm_up(replica.pool, replica.name)
+            except mariadb.Error as e:
+                replica.eject(e)
+
+
+def _warm_up(from_pool: mariadb.ConnectionPool, name: str):
+    """
+    Checks every connection of a pool out and pings it
+    :param from_pool: Pool to warm up
+    :param name: Name of the pool for the logs
+    :return: None
+    """
+    connections = []
+    try:
+        for _ in range(from_pool.pool_size):
+            try:
+                connection = from_pool.get_connection()
+            except mariadb.PoolError:
+                break
+            if connection is None:
+                break
+            connection.ping()
+            connections.append(connection)
+    finally:
+        for connection in connections:
+            connection.close()
+    logging.info(f"Warmed up {len(connections)} connections in {name}")
+
+
+def _reset_pool_after_fork():
+    """
+    Drops the pools inherited from the parent process. The child creates its own pools on first use
+    :return: None
+    """
+    global pool, _pool_lock, _connection_ids_lock
+    if pool is not None:
+        _inherited_pools.append(pool)
+    _inherited_pools.extend(replica.pool for replica in replica_pools if replica.pool is not None)
+    for name in [POOL_NAME] + [replica.name for replica in replica_pools]:
+        pool_active_connections.set(0, pool=name)
+    pool = None
+    replica_pools.clear()
+    # Locks held by other threads at fork time would never be released in the child
+    _pool_lock = threading.Lock()
+    _connection_ids_lock = threading.Lock()
+    _connection_ids.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
 
 
 def get_db_connection(debug=False) -> mariadb.Connection:
@@ -53,42 +255,414 @@ def get_db_connection(debug=False) -> mariadb.Connection:
     :param debug:
     :return:
     """
-    if not pool:
-        init_connection_pool(debug)
+    ensure_connection_pool(debug)
 
     if not g.get('db_connection'):
-        g.db_connection = pool.get_connection()
+        g.db_connection = checkout_connection()
     return g.db_connection
 
 
-def get_cursor(debug=False) -> (mariadb.Connection, mariadb.Cursor):
+def get_replica_connection(debug=False) -> mariadb.Connection:
+    """
+    Gets a connection from the next healthy replica, round-robin. Falls back to the primary if there are no replicas
+    or none of them has a free connection
+    :param debug:
+    :return:
+    """
+    ensure_connection_pool(debug)
+
+    if g.get('db_replica_connection'):
+        return g.db_replica_connection
+
+    replica, connection = _checkout_replica()
+    if connection is None:
+        return get_db_connection(debug)
+
+    g.db_replica_connection = connection
+    g.db_replica = replica
+    return connection
+
+
+def _checkout_replica() -> (ReplicaPool | None, mariadb.Connection | None):
+    """
+    Takes a connection out of the next healthy replica which has a free one, round-robin. Failing replicas are ejected
+    :return: The replica and its connection, or (None, None) if no replica has a free connection
+    """
+    for _ in range(len(replica_pools)):
+        replica = replica_pools[next(_replica_counter) % len(replica_pools)]
+        if not replica.healthy:
+            continue
+        try:
+            replica.connect()
+            connection = _checkout(replica.pool, replica.name, 0)
+            if connection is None:
+                continue  # Busy, try the next replica
+            if replica.ejected:
+                # First use after an ejection. Make sure it is back before routing requests to it
+                try:
+                    connection.ping()
+                except mariadb.Error as e:
+                    _record_checkin(connection)
+                    connection.close()
+                    raise e
+                replica.ejected = False
+        except mariadb.Error as e:
+            replica.eject(e)
+            continue
+        return replica, connection
+    return None, None
+
+
+def stream_rows(query: str, params: tuple = (), batch_size: int = 1000, replica: bool = True,
+                dictionary: bool = True):
+    """
+    Runs a read-only query with an unbuffered cursor and yields the rows in batches as they arrive from the server,
+    so the memory used does not depend on the size of the result.
+    The query runs on a connection of its own, not on the request connection, since nothing else can run on a
+    connection until its unbuffered result has been read. The connection is returned to the pool once the generator
+    is exhausted or closed.
+    :param query: Query to run
+    :param params: Values to bind to the query
+    :param batch_size: Number of rows fetched at once
+    :param replica: Whether the query may run on a replica
+    :param dictionary: Whether the rows are returned as dicts instead of tuples
+    :return: Generator of lists of rows
+    :raises ServiceUnavailableError: If maxStreams results are streamed already or the pool has no free connection
+        within checkout_timeout
+    """
+    ensure_connection_pool()
+
+    slots = stream_slots
+    if not slots.acquire(blocking=False):
+        raise ServiceUnavailableError("Too many results are being streamed, try again later", retry_after)
+    try:
+        source, connection = _checkout_replica() if replica and can_read_from_replica() else (None, None)
+        if connection is None:
+            connection = checkout_connection()
+    except Exception as e:
+        slots.release()
+        raise e
+    # The generator may be closed after the request, e.g. garbage collected once the client went away, where there
+    # is no application context anymore
+    checkout = _take_checkout(connection)
+
+    cursor = None
+    try:
+        cursor = connection.cursor(dictionary=dictionary, buffered=False)
+        # The server gives up on a client which does not read for net_write_timeout seconds. A slow reader of a
+        # long export would otherwise lose the connection halfway
+        cursor.execute("SET SESSION net_write_timeout = ?", (stream_write_timeout,))
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    except (mariadb.OperationalError, mariadb.InterfaceError) as e:
+        if source is not None:
+            source.eject(e)
+        raise e
+    finally:
+        try:
+            if cursor is not None:
+                try:
+                    cursor.close()  # Discards the rows which were not read
+                except mariadb.Error as e:
+                    logging.warning(f"Failed to close the streaming cursor: {e}")
+            _checkin_metrics(connection, checkout)
+        finally:
+            connection.close()
+            slots.release()
+
+
+def report_replica_failure(error):
+    """
+    Ejects the replica used by the current request after a connection level error and returns its connection, the
+    next reads of the request check out another one
+    :param error:
+    :return: None
+    """
+    replica = g.pop('db_replica', None)
+    if replica is not None:
+        replica.eject(error)
+    connection = g.pop('db_replica_connection', None)
+    if connection is not None:
+        _record_checkin(connection)
+        connection.close()
+
+
+def record_write():
+    """
+    Remembers that the current client wrote to the primary, so it reads its own writes for read_your_writes_window
+    seconds even if the replicas lag behind. Kept in a cookie of its own, reading the Flask session would add
+    Vary: Cookie to the public catalog responses
+    :return: None
+    """
+    if has_request_context() and replica_pools:
+        g.db_last_write = time.time()
+
+
+def _last_write() -> float | None:
+    """
+    Gets when the current client last wrote, from this request or its LAST_WRITE_COOKIE
+    :return: Seconds since the epoch or None
+    """
+    last_write = g.get('db_last_write')
+    if last_write is None and LAST_WRITE_COOKIE in request.cookies:
+        try:
+            last_write = float(request.cookies[LAST_WRITE_COOKIE])
+        except ValueError:
+            return None
+    return last_write
+
+
+def _set_last_write_cookie(response):
+    last_write = g.get('db_last_write')
+    if last_write is not None:
+        response.set_cookie(LAST_WRITE_COOKIE, f"{last_write:.3f}", max_age=math.ceil(read_your_writes_window),
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def read_from_primary_after(written_at: float):
+    """
+    Sends the read-only queries of the current request to the primary if the last write, by any session, is younger
+    than read_your_writes_window, since the replicas may not have it yet. For responses tagged with the version of the
+    data, which must not carry older rows
+    :param written_at: Seconds since the epoch of the last write
+    :return: None
+    """
+    if has_app_context() and replica_pools and time.time() - written_at < read_your_writes_window:
+        g.db_primary_only = True
+
+
+def can_read_from_replica() -> bool:
+    """
+    Checks if a read-only query of the current request may go to a replica
+    :return:
+    """
+    if not replica_pools:
+        return False
+    if has_app_context() and g.get('db_primary_only'):
+        return False
+    if has_request_context():
+        last_write = _last_write()
+        # A forged time in the future does not pin the client to the primary
+        if last_write is not None and 0 <= time.time() - last_write < read_your_writes_window:
+            return False
+    return True
+
+
+def _server_connection_id(connection: mariadb.Connection) -> int | None:
+    try:
+        return connection.connection_id
+    except mariadb.Error:
+        return None
+
+
+def _track_reconnect(connection: mariadb.Connection, previous_id: int | None, name: str) -> int | None:
+    """
+    Counts a reconnect if the server connection id changed and remembers the current one
+    :param connection: Pooled connection
+    :param previous_id: Server connection id seen last time
+    :param name: Name of the pool the connection belongs to
+    :return: The current server connection id
+    """
+    current_id = _server_connection_id(connection)
+    if previous_id is not None and current_id is not None and previous_id != current_id:
+        pool_reconnects.inc(pool=name)
+    return current_id
+
+
+def checkout_connection() -> mariadb.Connection:
+    """
+    Takes a connection out of the primary pool and records the pool metrics. The connection must be returned with
+    close_connection
+    :return: Pooled connection
+    :raises ServiceUnavailableError: If the pool has no free connection within checkout_timeout
+    """
+    connection = _checkout(pool, POOL_NAME, checkout_timeout)
+    if connection is None:
+        logging.error(f"{POOL_NAME} exhausted, no connection available within {checkout_timeout}s")
+        raise ServiceUnavailableError("Database connection pool exhausted", retry_after)
+    return connection
+
+
+def _checkout(from_pool: mariadb.ConnectionPool, name: str, timeout: float) -> mariadb.Connection | None:
+    """
+    Takes a connection out of a pool and records the pool metrics
+    :param from_pool: Pool to take the connection from
+    :param name: Name of the pool
+    :param timeout: Seconds to wait for a free connection
+    :return: Pooled connection or None if the pool is exhausted
+    """
+    started = time.perf_counter()
+    connection = _wait_for_connection(from_pool, timeout)
+    if connection is None:
+        pool_exhausted.inc(pool=name)
+        return None
+
+    pool_checkout_wait.observe(time.perf_counter() - started, pool=name)
+    pool_active_connections.inc(pool=name)
+    with _connection_ids_lock:
+        previous_id = _connection_ids.get(id(connection))
+    connection_id = _track_reconnect(connection, previous_id, name)
+    g.setdefault('db_checkouts', {})[id(connection)] = (name, time.perf_counter(), connection_id)
+    return connection
+
+
+def _wait_for_connection(from_pool: mariadb.ConnectionPool, timeout: float) -> mariadb.Connection | None:
+    """
+    Polls the pool for a free connection with a backoff until the timeout runs out.
+    The pool does not block on its own, it fails right away when every connection is checked out
+    :param from_pool: Pool to take the connection from
+    :param timeout: Seconds to wait
+    :return: Pooled connection or None
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        try:
+            connection = from_pool.get_connection()
+        except mariadb.PoolError:
+            connection = None
+        remaining = deadline - time.monotonic()
+        if connection is not None or remaining <= 0:
+            return connection
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+
+
+def _record_checkin(connection: mariadb.Connection):
+    """
+    Records the pool metrics of a connection going back to the pool
+    :param connection: Pooled connection
+    :return: None
+    """
+    _checkin_metrics(connection, _take_checkout(connection))
+
+
+def _take_checkout(connection: mariadb.Connection) -> tuple | None:
+    """
+    Removes the checkout record of a connection from the application context
+    :param connection: Pooled connection
+    :return: The record or None if the connection was not checked out in this context
+    """
+    return g.get('db_checkouts', {}).pop(id(connection), None)
+
+
+def _checkin_metrics(connection: mariadb.Connection, checkout: tuple | None):
+    """
+    Records the pool metrics of a connection going back to the pool, without the application context
+    :param connection: Pooled connection
+    :param checkout: Checkout record taken by _take_checkout
+    :return: None
+    """
+    if checkout is None:
+        return
+    name, started, previous_id = checkout
+    pool_checkout_duration.observe(time.perf_counter() - started, pool=name)
+    pool_active_connections.dec(pool=name)
+    current_id = _track_reconnect(connection, previous_id, name)
+    with _connection_ids_lock:
+        _connection_ids[id(connection)] = current_id
+
+
+def _describe_pool(name: str, _pool: mariadb.ConnectionPool | None) -> dict:
+    active = pool_active_connections.get(pool=name)
+    return {
+        'name': name,
+        'initialized': _pool is not None,
+        'size': _pool.pool_size if _pool else 0,
+        'active': active,
+        'idle': max(_pool.pool_size - active, 0) if _pool else 0,
+        'exhausted': pool_exhausted.get(pool=name),
+        'reconnects': pool_reconnects.get(pool=name),
+    }
+
+
+def pool_state() -> dict:
+    """
+    Gets the state of the connection pool and the replica pools, used by the health endpoint
+    :return: dict describing the pool
+    """
+    state = _describe_pool(POOL_NAME, pool)
+    state['replicas'] = [{**_describe_pool(replica.name, replica.pool), 'healthy': replica.healthy,
+                          'ejections': replica_ejections.get(pool=replica.name)}
+                         for replica in replica_pools]
+    return state
+
+
+def get_cursor(debug=False, prepared=False, replica=False, dictionary=True) -> (mariadb.Connection, mariadb.Cursor):
     """
     Gets a cursor and connection from the connection pool
     :param debug:
+    :param prepared: Whether the cursor should execute statements as server side prepared statements
+    :param replica: Whether the cursor may read from a replica. Only for read-only queries
+    :param dictionary: Whether the rows are returned as dicts instead of tuples
     :return:
     """
-    connection = get_db_connection(debug)
-    cursor = connection.cursor(dictionary=True)
+    connection = get_replica_connection(debug) if replica else get_db_connection(debug)
+    cursor = connection.cursor(dictionary=dictionary, prepared=prepared)
     return connection, cursor
 
 
+def column_names(cursor: mariadb.Cursor) -> tuple:
+    """
+    Gets the column names of the last result of a cursor, used to map tuple rows with Model.from_rows
+    :param cursor:
+    :return: tuple of column names in the order of the row values
+    """
+    return tuple(column[0] for column in cursor.description)
+
+
 def close_connection(error=None):
     """
-    Closes the database connection
+    Closes the database connections
     :param error:
     :return:
     """
     logging.debug("Closing database connection")
-    logging.error(error)
+    if error:
+        logging.error(error)
     db = g.pop('db_connection', None)
     if db is not None:
+        if error:
+            db.rollback()
+        _record_checkin(db)
         db.close()
 
+    g.pop('db_replica', None)
+    replica_db = g.pop('db_replica_connection', None)
+    if replica_db is not None:
+        _record_checkin(replica_db)
+        replica_db.close()
+
+
+def is_request_scoped() -> bool:
+    """
+    Checks if the connection is kept for the whole request and returned to the pool by teardown_appcontext
+    instead of after every manager call
+    :return:
+    """
+    return has_app_context() and current_app.config.get('DATABASE_REQUEST_SCOPED', False)
+
 
 def init_app(app):
     """
     Database Specific Flask initialization
+    Every manager call in a request shares one pooled connection which is returned once the request is finished.
+    The pool is created and warmed up here. Pre-fork servers which create the app before forking (gunicorn --preload)
+    drop the inherited pool in every worker and create a new one on first use.
     :param app:
     :return:
     """
+    app.config['DATABASE_REQUEST_SCOPED'] = True
     app.teardown_appcontext(close_connection) # Close connection after request is finished
+    app.after_request(_set_last_write_cookie)
+    if config.get_database_config().get('warmUp', 'ENABLED') == 'ENABLED':
+        try:
+            warm_up_pool()
+        except mariadb.Error as e:
+            # The app can still start, the pool is retried lazily by the first request
+            logging.error(f"Failed to warm up the connection pool: {e}")
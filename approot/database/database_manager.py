@@ -3,21 +3,158 @@ from contextlib import contextmanager
 from functools import wraps
 
 import mariadb
+from flask import g, has_app_context
 
-from approot.database.database import get_cursor, close_connection
+from approot.database.database import get_cursor, close_connection, is_request_scoped, can_read_from_replica, \
+    record_write, report_replica_failure
+
+
+class UnitOfWorkConnection:
+    """
+    Connection handed to managers inside a unit of work.
+    Commits are deferred to the end of the unit of work and a rollback marks the whole unit to be rolled back.
+    Everything else is passed through to the pooled connection.
+    """
+
+    def __init__(self, connection: mariadb.Connection):
+        self._connection = connection
+
+    def commit(self):
+        g.db_unit_wrote = True  # Committed once by the outermost unit_of_work
+
+    def rollback(self):
+        g.db_rollback_only = True
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class WriteRecordingConnection:
+    """
+    Connection handed to managers outside a unit of work. A commit is remembered as a write of the client, so it reads
+    its own writes. Everything else is passed through to the pooled connection.
+    """
+
+    def __init__(self, connection: mariadb.Connection):
+        self._connection = connection
+
+    def commit(self):
+        self._connection.commit()
+        record_write()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def in_unit_of_work() -> bool:
+    """
+    Checks if the current code runs inside a unit_of_work block
+    :return:
+    """
+    return has_app_context() and g.get('db_unit_of_work', 0) > 0
+
+
+def call_after_commit(callback):
+    """
+    Calls the callback once the current work is committed.
+    Inside a unit of work that is when the outermost unit commits, otherwise it is called right away.
+    :param callback: Function without arguments
+    :return: None
+    """
+    if in_unit_of_work():
+        g.db_after_commit.append(callback)
+    else:
+        callback()
 
 
 @contextmanager
-def get_database_connection():
+def unit_of_work():
+    """
+    Context manager joining every manager call inside it to one connection and one transaction.
+    The managers' commits are deferred and the transaction is committed once when the outermost block exits,
+    if anything inside fails the whole unit is rolled back.
+    Usage:
+        with unit_of_work():
+            product = ProductManager.get_product_by_id(product_id)
+            ProductManager.delete_product(product_id)
+    :return: None
+    """
+    depth = g.get('db_unit_of_work', 0)
+    if depth == 0:
+        g.db_rollback_only = False
+        g.db_unit_wrote = False
+        g.db_after_commit = []
+    g.db_unit_of_work = depth + 1
+    try:
+        yield
+    except Exception as e:
+        g.db_rollback_only = True
+        raise e
+    finally:
+        g.db_unit_of_work = depth
+        if depth == 0:
+            _finish_unit_of_work()
+
+
+def _finish_unit_of_work():
+    """
+    Commits or rolls back the outermost unit of work and runs the after commit callbacks
+    :return: None
+    """
+    connection = g.get('db_connection')
+    callbacks = g.pop('db_after_commit', [])
+    wrote = g.pop('db_unit_wrote', False)
+    try:
+        if connection is not None:
+            if g.pop('db_rollback_only', False):
+                connection.rollback()
+                callbacks = []
+            else:
+                connection.commit()
+                if wrote:
+                    record_write()
+    finally:
+        if not is_request_scoped():
+            close_connection()
+
+    for callback in callbacks:
+        callback()
+
+
+def _uses_replica(read_only: bool, primary: bool) -> bool:
+    return read_only and not primary and not in_unit_of_work() and can_read_from_replica()
+
+
+@contextmanager
+def get_database_connection(prepared=False, read_only=False, dictionary=True, primary=False):
     """
     Context manager for getting a database connection and cursor
+    Inside a unit of work the connection of the unit is joined and left open.
+    In a request the connection is kept until the request is torn down, so it is only checked out of the pool once.
+    The cursor is closed when the block exits and read-only work outside a unit of work is ended with a rollback.
+    A commit outside a unit of work, or of a unit of work whose managers committed, is recorded as a write of the
+    client, see record_write
+    :param prepared: Whether the cursor should execute statements as server side prepared statements
+    :param read_only: Whether the work only reads. Read-only work goes to a replica if one is configured, unless it
+        runs in a unit of work or the session wrote recently
+    :param dictionary: Whether the cursor returns dicts. Tuple rows are cheaper, map them with Model.from_rows
+    :param primary: Whether read-only work must read the primary, because a lagging replica could miss rows
     :return: database connection and cursor
     """
     database = None
+    cursor = None
+    joined = in_unit_of_work()
+    replica = _uses_replica(read_only, primary)
     try:
-        database, cursor = get_cursor()
+        database, cursor = get_cursor(prepared=prepared, replica=replica, dictionary=dictionary)
+        database = UnitOfWorkConnection(database) if joined else WriteRecordingConnection(database)
         yield database, cursor
+        if read_only and not joined:
+            # Ends the transaction of the reads, a long request does not keep one consistent read view open
+            database.rollback()
     except mariadb.Error as e:
+        if replica and isinstance(e, (mariadb.OperationalError, mariadb.InterfaceError)):
+            report_replica_failure(e)  # Before the rollback, which fails too on a broken connection
         if database:
             database.rollback()
         raise e
@@ -27,27 +164,56 @@ def get_database_connection():
         logging.error(f"Unknown error occurred: {e}")
         raise e
     finally:
-        logging.critical("Closing database connection")
-        close_connection()
+        if cursor is not None:
+            try:
+                cursor.close()
+            except mariadb.Error as e:
+                logging.warning(f"Failed to close the cursor: {e}")
+        if not joined and not is_request_scoped():
+            logging.debug("Closing database connection")
+            close_connection()
 
 
-def database_transaction_helper(func):
+def database_transaction_helper(func=None, *, prepared=False, read_only=False, dictionary=True, primary=False):
     """
     Decorator for handling database transactions. Sets up and tears down the database connection and cursor.
+    Can be used bare or with arguments: @database_transaction_helper(prepared=True)
+    A read which fails on a replica with a connection error ejects the replica and is retried once on the primary.
     :param func:
+    :param prepared: Whether the cursor should execute statements as server side prepared statements.
+        Use it for queries whose text only depends on the shape of the input, like compiled filters.
+    :param read_only: Whether the function only reads. Read-only functions may be served by a read replica,
+        never use it for functions which write or lock rows (FOR UPDATE)
+    :param dictionary: Whether the cursor returns dicts. Hot read paths use tuple rows and Model.from_rows
+    :param primary: Whether a read-only function must read the primary, e.g. to rebuild a copy of a table
     :return:
     """
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        with get_database_connection() as (database, cursor):
-            if database is None:
-                raise mariadb.Error("Failed to connect to database")
+    def decorator(func):
+        def call(use_primary, args, kwargs):
+            with get_database_connection(prepared=prepared, read_only=read_only, dictionary=dictionary,
+                                         primary=use_primary) as (database, cursor):
+                if database is None:
+                    raise mariadb.Error("Failed to connect to database")
+                try:
+                    return func(database=database, cursor=cursor, *args, **kwargs)
+                except mariadb.Error as e:
+                    logging.error(f"Database Error: {e}")
+                    raise e
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            replica = _uses_replica(read_only, primary)
             try:
-                return func(database=database, cursor=cursor, *args, **kwargs)
-            except mariadb.Error as e:
-                logging.error(f"Database Error: {e}")
-                database.rollback()
-                raise e
+                return call(primary, args, kwargs)
+            except (mariadb.OperationalError, mariadb.InterfaceError) as e:
+                if not replica:
+                    raise e
+                logging.warning(f"Read replica failed, retrying on the primary: {e}")
+                return call(True, args, kwargs)
+
+        return wrapper
 
-    return wrapper
+    if func is not None:
+        return decorator(func)
+    return decorator
@@ -1,6 +1,41 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from operator import itemgetter
 
-@dataclass
+from approot.utils.images import image_srcsets, thumbnail_url
+
+
+@lru_cache(maxsize=256)
+def field_names(cls) -> tuple:
+    """
+    Gets the field names of a model in the order of its constructor arguments
+    :param cls: Model class
+    :return: tuple of field names
+    """
+    return tuple(field.name for field in fields(cls))
+
+
+@lru_cache(maxsize=256)
+def _row_getter(cls, columns: tuple):
+    """
+    Column-index map of a result for a model. Picks the values of the model fields, in constructor order, out of a
+    tuple row. Cached per model and column list, so it is built once per query shape
+    :param cls: Model class
+    :param columns: Column names of the result
+    :return: Function returning the constructor arguments of a row
+    :raises KeyError: If the result is missing a field of the model
+    """
+    missing = [name for name in field_names(cls) if name not in columns]
+    if missing:
+        raise KeyError(f"Result is missing the columns {missing} of {cls.__name__}")
+    indexes = [columns.index(name) for name in field_names(cls)]
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    return itemgetter(*indexes)
+
+
+@dataclass(slots=True)
 class Product:
     name: str
     price: int
@@ -15,6 +50,27 @@ class Product:
             return None
         return cls(**data)
 
+    @classmethod
+    def from_row(cls, row: tuple, columns: tuple):
+        """
+        Builds a product from a tuple row, see from_rows
+        """
+        if not row:
+            return None
+        return cls(*_row_getter(cls, columns)(row))
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple], columns: tuple) -> list:
+        """
+        Builds products positionally from the tuple rows of a cursor opened with dictionary=False.
+        Skips the dict of every row and the keyword matching of from_dict
+        :param rows: Rows of the result
+        :param columns: Column names of the result, see database.column_names
+        :return: list of Product
+        """
+        getter = _row_getter(cls, columns)
+        return [cls(*getter(row)) for row in rows]
+
     def to_dict(self):
         return {
             'name': self.name,
@@ -22,6 +78,8 @@ class Product:
             'description': self.description,
             'stock': self.stock,
             'location': self.location,
+            'thumbnail': thumbnail_url(self.location),  # The image itself until its thumbnail is generated
+            'images': image_srcsets(self.location),  # srcset of the resized copies by mimetype
             'product_id': self.product_id
         }
 
@@ -0,0 +1,4 @@
+-- Lets the catalog snapshot read only the products changed since its last refresh
+ALTER TABLE products
+    ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+    ADD INDEX idx_products_updated_at (updated_at);
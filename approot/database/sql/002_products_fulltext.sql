@@ -0,0 +1,4 @@
+-- Lets GET /api/products/?search= use MATCH ... AGAINST instead of scanning the table with LIKE '%value%'.
+-- Words shorter than innodb_ft_min_token_size (3 by default) are not indexed
+ALTER TABLE products
+    ADD FULLTEXT INDEX ft_products_name_description (name, description);
@@ -0,0 +1,4 @@
+-- Lets remove_image_from_disk count the products using an image without scanning the table.
+-- Identical uploads are stored once, so an image is only removed when no product references it anymore
+ALTER TABLE products
+    ADD INDEX idx_products_location (location(255));
@@ -0,0 +1,57 @@
+from flask import Blueprint, request
+
+from approot.data_managers.errors import CheckoutError
+from approot.data_managers.product_manager import ProductManager
+from approot.utils.utils import error_response, success_response, validate_key_, handle_error_flask
+
+cart_api = Blueprint('cart_api', __name__, url_prefix='/api/cart')
+
+
+@cart_api.route('checkout', methods=['POST'])
+@validate_key_
+@handle_error_flask
+def checkout():
+    """
+    Endpoint for buying every product of a cart at once. Automatically subtracts the quantities from the stock.
+    Either the whole cart is bought or nothing is.
+    The cookie key must be set to a valid key.
+    The connection must be https (for security).
+
+    The Content-Type header must be set to application/json.
+    The body must be a JSON object containing the following:
+        items - An array of lines, each containing the product_id and the quantity to buy.
+
+    Request:
+
+    POST /api/cart/checkout
+    Content-Type: application/json
+    {
+        "items": [{"product_id": 1, "quantity": 2}, {"product_id": 7, "quantity": 1}]
+    }
+
+    Response:
+        {
+            "status": "success",
+            "message": "Checked out cart successfully",
+            "data": [
+                {"product_id": 1, "quantity": 2, "status": "ok"},
+                {"product_id": 7, "quantity": 1, "status": "ok"}
+            ]
+        }
+    If a line cannot be bought the status is 409 and data contains every line, the failed ones have the status
+    "not_found" or "insufficient_stock" (with the "available" stock).
+    :return: A JSON object containing the result of every line.
+    """
+    # Check if https
+    if request.scheme != "https":
+        return error_response("HTTPS Required", 400)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return error_response("The body must be a JSON object", 400)
+
+    try:
+        lines = ProductManager.buy_products(data.get('items'))
+    except CheckoutError as e:
+        return error_response(str(e), 409, e.lines)
+    return success_response("Checked out cart successfully", lines)
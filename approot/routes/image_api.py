@@ -0,0 +1,75 @@
+import re
+
+from flask import Blueprint, abort, send_file
+
+from approot.data_managers.errors import NotFoundError
+from approot.utils.images import image_queue, SERVER_URL_ROOT
+from approot.utils.resized_images import resized_cache
+from approot.utils.utils import success_response, handle_error_flask
+
+image_api = Blueprint('image_api', __name__, url_prefix='/api/images')
+image_files = Blueprint('image_files', __name__, url_prefix=SERVER_URL_ROOT)
+CONTENT_ADDRESSED = re.compile(r'[0-9a-f]{64}\.\w+')  # Named by their SHA-256, the bytes of a name never change
+
+
+@image_api.route('jobs/<job_id>', methods=['GET'])
+@handle_error_flask
+def get_image_job(job_id: str):
+    """
+    Endpoint for following the processing of an uploaded image. The job id is returned as image_job by the endpoints
+    which accept an image. Until the job is done the product is shown with its original image.
+
+    Request:
+    GET /api/images/jobs/5f1c...9a.jpg
+
+    Response:
+    {
+        "status": "success",
+        "data": {
+            "job_id": "5f1c...9a.jpg",
+            "status": "done",
+            "error": null,
+            "created": 1760000000.0,
+            "finished": 1760000001.2
+        }
+    }
+    The status is one of queued, running, done, failed or unknown (queued by another process which may have died).
+    :param job_id: The id of the job
+    :return:
+    """
+    job = image_queue.get(job_id)
+    if job is None:
+        raise NotFoundError("No image job found with the provided ID")
+    return success_response("Retrieved image job successfully", job)
+
+
+@image_files.route('<int:width>x<int:height>/<filename>', methods=['GET'])
+def get_resized_image(width: int, height: int, filename: str):
+    """
+    Endpoint for an image resized to fit in a box, keeping its aspect ratio. The image is resized on the first request
+    and served from disk afterwards. The allowed sizes are set by resizedSizes in the [Images] section of config.ini.
+
+    Request:
+    GET /images/products/256x256/5f1c...9a.jpg
+
+    Response:
+    The resized image, or 404 if the size is not allowed or there is no such image
+    :param width: Width of the box
+    :param height: Height of the box
+    :param filename: Filename of the image, the last part of its location
+    :return:
+    """
+    immutable = CONTENT_ADDRESSED.fullmatch(filename) is not None
+    for _ in range(2):
+        path = resized_cache.get(width, height, filename)
+        if path is None:
+            abort(404)
+        try:
+            response = send_file(path, conditional=True, max_age=31536000 if immutable else None)
+        except FileNotFoundError:
+            continue  # Evicted by another worker process in between, resize it again
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        return response
+    abort(503)
@@ -0,0 +1,41 @@
+import logging
+
+import mariadb
+from flask import Blueprint, Response
+
+from approot.database.database import get_db_connection, pool_state
+from approot.metrics import registry
+from approot.utils.utils import error_response, success_response
+
+metrics_api = Blueprint('metrics_api', __name__, url_prefix='/api')
+
+
+@metrics_api.route('metrics', methods=['GET'])
+def metrics():
+    """
+    Endpoint for scraping the metrics of this process in the Prometheus text format.
+    Contains the connection pool metrics, the query cache counters and the latency of every endpoint.
+    :return: text/plain response
+    """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics_api.route('health', methods=['GET'])
+def health():
+    """
+    Readiness probe. Checks a connection out of the pool and pings the database.
+
+    Response:
+    {
+        "status": "success",
+        "message": "Ready",
+        "data": {"pool": {"name": "FlowerPool", "initialized": true, "size": 10, "active": 1, "idle": 9, ...}}
+    }
+    :return: 200 if the database is reachable, 503 if not
+    """
+    try:
+        get_db_connection().ping()
+    except mariadb.Error as e:
+        logging.error(f"Health check failed: {e}")
+        return error_response(f"Not ready: {e}", 503, {'pool': pool_state()})
+    return success_response("Ready", {'pool': pool_state()})
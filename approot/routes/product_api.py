@@ -1,18 +1,24 @@
+import itertools
 import json
 import logging
 from functools import wraps
 
 import mariadb
-from flask import Blueprint, request
+from flask import Blueprint, Response, request, stream_with_context
 
 from approot.data_managers.errors import NotFoundError, InvalidActionError
 from approot.data_managers.product_manager import ProductManager
-from approot.database.models import Filter
+from approot.data_managers.suggest import suggestion_index
+from approot.utils.images import image_filename
+from approot.database.database_manager import unit_of_work
+from approot.database.models import Filter, Product
 from approot.utils.utils import handle_unauthorized, error_response, handle_json_error, success_response, \
     validate_key_, save_image_to_disk_by_file, save_image_to_disk_by_url, InvalidMimetypeError, handle_not_found_error, \
-    handle_database_error, handle_validation_error, handle_error_flask, remove_image_from_disk
+    handle_database_error, handle_validation_error, handle_error_flask, remove_image_from_disk, encode_cursor, \
+    decode_cursor, catalog_response, dumps_ndjson, compile_search_query
 
 product_api = Blueprint('product_api', __name__, url_prefix='/api/products')
+MAX_SUGGESTIONS = 20
 
 
 def parse_image(data: dict) -> str | None:
@@ -51,6 +57,7 @@ def api_test():
 
 
 @product_api.route('/', methods=['GET'])
+@catalog_response
 @handle_error_flask
 def get_products():
     """
@@ -68,9 +75,15 @@ def get_products():
         - comparator (str): The comparator to use for the filter. Must be one of the following: AND, OR. Default is AND.
     - limit (optional): The maximum number of results to return. Default is 10.
     - offset (optional): The offset to start the query at. Default is 0.
+    - cursor (optional): The cursor returned by the previous page. When set the offset is ignored and the query
+        seeks directly to the next page, which stays fast no matter how deep the page is.
+    - search (optional): Words to search for in the name and description. Every word must match, the last one may be
+        the beginning of a word. The results are ordered by relevance and paginated with limit/offset only.
 
     Request:
     GET /api/products/?filters=[{"field": "name", "rule": "contains", "value": "Example", "negate": false, "comparator": "AND"}]&limit=10&offset=0
+    GET /api/products/?filters=[]&limit=10&cursor=eyJwcm9kdWN0X2lkIjoxMH0
+    GET /api/products/?filters=[]&limit=10&offset=0&search=red%20ros
 
     Response:
     {
@@ -85,8 +98,10 @@ def get_products():
                 "location": "/images/example1.jpg"
             },
             ...
-        ]
+        ],
+        "cursor": "eyJwcm9kdWN0X2lkIjoxMH0"
     }
+    The cursor is null once the last page has been reached, and always when searching.
     """
 
     # Extracting query parameters from the URL
@@ -107,17 +122,38 @@ def get_products():
     #print(filters)
     limit = request.args.get('limit', default=10, type=int)
     offset = request.args.get('offset', default=0, type=int)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    search = request.args.get('search')
     #print(limit, offset)
+    # A search of punctuation only searches nothing, the products are listed and paginated as without it
+    searching = compile_search_query(search) is not None
+
+    if searching or (after is None and offset):
+        products = ProductManager.get_all_products(filters=filters,
+                                                   limit=limit,
+                                                   offset=offset,
+                                                   after=after,
+                                                   search=search)
+        more = not searching and len(products) >= limit and _has_products_after(filters, products[-1])
+    else:
+        # One product more than the page tells whether there is a next page
+        products = ProductManager.get_all_products(filters=filters, limit=limit + 1, after=after)
+        more = len(products) > limit
+        products = products[:limit]
+    next_cursor = encode_cursor(products[-1]) if more and products else None
+    logging.debug(f"Retrieved {len(products)} products")
+    return success_response("Retrieved products successfully", products, cursor=next_cursor)
 
-    products = ProductManager.get_all_products(filters=filters,
-                                               limit=limit,
-                                               offset=offset)
-    logging.critical(products)
-    logging.critical("TESTING")
-    test_dump = json.dumps([product.to_dict() for product in products], separators=(',', ':'))
-    logging.critical(test_dump)
-    return success_response("Retrieved products successfully",
-                            json.dumps([product.to_dict() for product in products], separators=(',', ':')))
+
+def _has_products_after(filters: list[Filter], product: Product) -> bool:
+    """
+    Checks if a product matching the filters follows the last product of a page
+    """
+    try:
+        return bool(ProductManager.get_all_products(filters=filters, limit=1, after=product.product_id))
+    except NotFoundError:
+        return False
 
 
 @product_api.route('/', methods=['POST'])
@@ -149,8 +185,10 @@ def add_product():
     {
         "status": "success",
         "message": "Inserted product successfully",
-        "data": {}
+        "data": {},
+        "image_job": "5f1c...9a.jpg"
     }
+    image_job is the id of the background processing of the image, see GET /api/images/jobs/<job_id>. null without image
     :return: A JSON object containing the status of the request.
 
     """
@@ -159,10 +197,118 @@ def add_product():
     data['location'] = location
 
     res = ProductManager.add_product(data)
-    return success_response("Inserted product successfully", res)
+    return success_response("Inserted product successfully", res, image_job=image_filename(location))
+
+
+@product_api.route('suggest', methods=['GET'])
+@catalog_response
+@handle_error_flask
+def suggest_products():
+    """
+    Endpoint for the type-ahead suggestions of the search box. Served from an in-memory index of the product names,
+    so it can be called on every keystroke without querying the database.
+
+    URL Parameters:
+    - q: What the user typed so far. Matches the start of the name or of any word of the name, case-insensitively.
+    - limit (optional): Maximum number of suggestions. Default is 10, at most 20.
+
+    Request:
+    GET /api/products/suggest?q=ro
+
+    Response:
+    {
+        "status": "success",
+        "data": [
+            {"product_id": 3, "name": "Rose Bouquet"},
+            {"product_id": 8, "name": "Red Roses"}
+        ]
+    }
+    Names starting with q come first, then the names with another word starting with q.
+    :return:
+    """
+    limit = request.args.get('limit', default=10, type=int)
+    if not 0 < limit <= MAX_SUGGESTIONS:
+        raise InvalidActionError(f"Invalid limit: '{limit}'")
+    suggestions = suggestion_index.suggest(request.args.get('q', default=''), limit)
+    return success_response("Retrieved suggestions successfully", suggestions)
+
+
+@product_api.route('export', methods=['GET'])
+@handle_error_flask
+def export_products():
+    """
+    Endpoint for exporting the whole catalog, e.g. for feed partners.
+    The products are streamed one JSON object per line (NDJSON) as they are read from the database, so the first
+    bytes are sent right away and the size of the catalog does not matter.
+
+    URL Parameters:
+    - format (optional): Format of the export. Only ndjson is supported. Default is ndjson.
+
+    Request:
+    GET /api/products/export?format=ndjson
+
+    Response:
+    Content-Type: application/x-ndjson
+    {"name":"Example Product 1","price":1999,"description":"Lorem ipsum...","stock":50,"location":"/images/example1.jpg","product_id":1}
+    {"name":"Example Product 2",...,"product_id":2}
+    ...
+    :return:
+    """
+    export_format = request.args.get('format', default='ndjson')
+    if export_format != 'ndjson':
+        raise InvalidActionError(f"Unsupported export format: '{export_format}'")
+
+    batches = ProductManager.export_products()
+    # Read the first batch before answering, so a database error is still sent as an error response
+    first = next(batches, [])
+
+    def generate():
+        for batch in itertools.chain([first], batches):
+            yield dumps_ndjson(batch)
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                        headers={'Content-Disposition': 'attachment; filename="products.ndjson"'})
+    # The body is not read for HEAD requests or clients which went away, the connection is returned anyway
+    response.call_on_close(batches.close)
+    return response
+
+
+@product_api.route('batch', methods=['GET'])
+@catalog_response
+@handle_error_flask
+def get_products_batch():
+    """
+    Endpoint for getting several products by their IDs with one request.
+
+    URL Parameters:
+    - ids: Comma separated list of product IDs. At most 100 IDs.
+
+    Request:
+    GET /api/products/batch?ids=3,1,42
+
+    Response:
+    {
+        "status": "success",
+        "data": [
+            {"product_id": 3, "name": "Example Product 3", ...},
+            {"product_id": 1, "name": "Example Product 1", ...}
+        ],
+        "missing": [42]
+    }
+    The products are returned in the order of the IDs, IDs which do not exist are listed in missing.
+    :return:
+    """
+    try:
+        product_ids = [int(product_id) for product_id in request.args.get('ids', '').split(',') if product_id.strip()]
+    except ValueError:
+        raise InvalidActionError(f"Invalid ids: '{request.args.get('ids')}'")
+
+    products, missing = ProductManager.get_products_by_ids(product_ids)
+    return success_response("Retrieved products successfully", products, missing=missing)
 
 
 @product_api.route('<int:product_id>/', methods=['GET'])
+@catalog_response
 def get_product(product_id: int):
     """
     Endpoint for getting a specific product
@@ -190,11 +336,12 @@ def get_product(product_id: int):
     :return:
     """
     res = ProductManager.get_product_by_id(product_id)
-    return success_response("Retrieved product successfully", res.to_dict())
+    return success_response("Retrieved product successfully", res)
 
 
 @product_api.route('<int:product_id>/', methods=['PUT'])
 @validate_key_
+@handle_error_flask
 def modify_product(product_id):
     """
     Endpoint for modifying a specific product.
@@ -221,8 +368,10 @@ def modify_product(product_id):
     {
         "status": "success",
         "message": "Updated product successfully",
-        "data": {}
+        "data": {},
+        "image_job": "5f1c...9a.jpg"
     }
+    image_job is the id of the background processing of the image, see GET /api/images/jobs/<job_id>. null without image
     :return:
     """
     data = json.loads(request.form.get('product'))
@@ -230,7 +379,7 @@ def modify_product(product_id):
     data['location'] = location
 
     res = ProductManager.update_product(product_id, data)
-    return success_response("Updated product successfully", res)
+    return success_response("Updated product successfully", res, image_job=image_filename(location))
 
 
 @product_api.route('<int:product_id>/', methods=['DELETE'])
@@ -255,8 +404,9 @@ def remove_product(product_id):
     }
     :return: A JSON object containing the status of the request.
     """
-    product = ProductManager.get_product_by_id(product_id)
-    res = ProductManager.delete_product(product_id)
+    with unit_of_work():
+        product = ProductManager.get_product_by_id(product_id)
+        res = ProductManager.delete_product(product_id)
     remove_image_from_disk(product.location)
     return success_response("Deleted product successfully", res)
 
@@ -0,0 +1,176 @@
+"""
+Removes the product images no product uses anymore.
+
+Images are left behind when a product gets a new image or an insert fails after its image was stored. The images
+directory is compared with products.location, which is streamed in batches, and the unreferenced originals are removed
+with their derivatives. Files younger than the grace period are kept, their product may not be committed yet.
+Derivatives and temporary files whose original is gone are removed too.
+
+Meant to run from cron, e.g. once a night:
+    python -m approot.utils.image_gc [--dry-run] [--grace SECONDS] [--batch-size N]
+"""
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+from flask import Flask
+
+from approot.database.database import stream_rows
+from approot.metrics import registry
+from approot.utils.images import UPLOAD_FOLDER, COMPRESSED_FOLDER, MIME_TYPES_BY_EXTENSION, GC_GRACE_PERIOD, \
+    image_filename, derivative_paths, forget_image
+
+image_gc_removed = registry.counter('flowers_image_gc_removed_files_total', 'Image files removed by the image GC')
+image_gc_reclaimed = registry.counter('flowers_image_gc_reclaimed_bytes_total', 'Bytes reclaimed by the image GC')
+
+
+class GcReport:
+    """
+    Result of one run of the image GC
+    """
+
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        self.originals = 0  # Originals on disk
+        self.referenced = 0  # Originals used by a product
+        self.young = 0  # Unreferenced originals kept for the grace period
+        self.removed = []  # Paths removed, or which would be removed by a dry run
+        self.reclaimed = 0  # Bytes
+
+    def to_dict(self):
+        return {
+            'dry_run': self.dry_run,
+            'originals': self.originals,
+            'referenced': self.referenced,
+            'young': self.young,
+            'removed': len(self.removed),
+            'reclaimed': self.reclaimed
+        }
+
+
+def is_original(path: Path) -> bool:
+    return path.is_file() and not path.name.startswith('.') \
+        and path.suffix[1:].lower() in MIME_TYPES_BY_EXTENSION
+
+
+def derivative_files() -> list[Path]:
+    """
+    Gets every thumbnail, resized copy, failure marker and temporary file of the image folders
+    """
+    files = [path for path in COMPRESSED_FOLDER.glob('*') if path.is_file()]
+    files += [path for path in COMPRESSED_FOLDER.glob('*x*/*') if path.is_file()]
+    files += [path for path in UPLOAD_FOLDER.glob('w*/*') if path.is_file()]
+    files += [path for path in UPLOAD_FOLDER.glob('.*.tmp') if path.is_file()]
+    files += [path for path in UPLOAD_FOLDER.glob('.*.failed') if path.is_file()]
+    return files
+
+
+def unreferenced(candidates: set[str], batch_size: int) -> set[str]:
+    """
+    Removes the images used by a product from the candidates. The locations are streamed from the primary, a replica
+    could miss a product which was just added
+    :param candidates: Filenames of the originals
+    :param batch_size: Number of locations fetched at once
+    :return: The candidates no product uses
+    """
+    candidates = set(candidates)
+    query = "SELECT location FROM products WHERE location IS NOT NULL"
+    for rows in stream_rows(query, batch_size=batch_size, replica=False, dictionary=False):
+        for (location,) in rows:
+            candidates.discard(image_filename(location))
+    return candidates
+
+
+def _remove(path: Path, report: GcReport):
+    try:
+        size = path.stat().st_size
+        if not report.dry_run:
+            path.unlink()
+    except FileNotFoundError:
+        return  # Removed by someone else meanwhile
+    report.removed.append(path)
+    report.reclaimed += size
+
+
+def collect_images(grace: float, dry_run: bool = False, batch_size: int = 10000) -> GcReport:
+    """
+    Removes the originals no product uses and which are older than the grace period, with their derivatives, then the
+    derivatives and temporary files whose original is gone
+    :param float grace: Seconds a file is kept after its last modification. Identical uploads refresh it
+    :param bool dry_run: Only report what would be removed
+    :param int batch_size: Number of locations fetched at once
+    :return: GcReport
+    :raises mariadb.Error: If the locations cannot be read, nothing is removed then
+    """
+    report = GcReport(dry_run)
+    if not UPLOAD_FOLDER.is_dir():
+        return report
+
+    cutoff = time.time() - grace
+    originals = {path.name: path for path in UPLOAD_FOLDER.glob('*') if is_original(path)}
+    report.originals = len(originals)
+    candidates = {name for name, path in originals.items() if path.stat().st_mtime < cutoff}
+    report.young = len(originals) - len(candidates)
+
+    orphans = unreferenced(candidates, batch_size)
+    report.referenced = len(candidates) - len(orphans)
+    for name in sorted(orphans):
+        path = originals[name]
+        try:
+            if path.stat().st_mtime >= cutoff:
+                report.young += 1  # Uploaded again while the locations were read
+                continue
+        except FileNotFoundError:
+            continue
+        _remove(path, report)
+        for derivative in derivative_paths(name):
+            _remove(derivative, report)
+        del originals[name]
+        forget_image(name)
+
+    # Derivatives whose original is gone, e.g. removed by hand, and temporary files of interrupted uploads
+    stems = {name.rsplit('.', 1)[0] for name in originals}
+    removed = set(report.removed)
+    for path in derivative_files():
+        name = path.name[1:-len('.failed')] if path.suffix == '.failed' else path.name
+        if path in removed or name.rsplit('.', 1)[0] in stems:
+            continue
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        _remove(path, report)
+
+    if not dry_run:
+        image_gc_removed.inc(len(report.removed))
+        image_gc_reclaimed.inc(report.reclaimed)
+    logging.info(f"Image GC {'(dry run) ' if dry_run else ''}removed {len(report.removed)} files, "
+                 f"{report.reclaimed} bytes, kept {report.referenced} referenced and {report.young} young originals")
+    return report
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Removes the product images no product uses anymore')
+    parser.add_argument('--dry-run', action='store_true', help='Only list what would be removed')
+    parser.add_argument('--grace', type=float, default=GC_GRACE_PERIOD,
+                        help='Seconds an unreferenced file is kept after its last modification')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Locations fetched from the database at once')
+    args = parser.parse_args(argv)
+
+    # The connection pool records its checkouts in the application context
+    with Flask(__name__).app_context():
+        report = collect_images(args.grace, args.dry_run, args.batch_size)
+
+    for path in report.removed:
+        print(f"{'Would remove' if args.dry_run else 'Removed'} {path.relative_to(UPLOAD_FOLDER)}")
+    print(f"{report.originals} originals, {report.referenced} referenced, {report.young} within the grace period. "
+          f"{'Would reclaim' if args.dry_run else 'Reclaimed'} {report.reclaimed} bytes "
+          f"({report.reclaimed / 2 ** 20:.1f} MiB) in {len(report.removed)} files")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
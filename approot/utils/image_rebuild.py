@@ -0,0 +1,183 @@
+"""
+Rebuilds the derivatives of the product images.
+
+Only images which are new, changed, or processed with other settings are rebuilt, the others are skipped using a
+manifest of the source digest and the derivative settings of every image. The work is spread over a process pool, the
+derivatives are swapped in atomically so the site keeps serving the previous ones while the rebuild runs.
+
+Usage:
+    python -m approot.utils.image_rebuild [--workers N] [--force]
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from approot import SERVER_ROOT
+from approot.importer import config
+from approot.utils.images import UPLOAD_FOLDER, COMPRESSED_FOLDER, WIDTHS, QUALITY, WEBP_QUALITY, WEBP, \
+    THUMBNAIL_SIZE, ORIGINAL_SIZE, MAX_ORIGINAL_BYTES, MIME_TYPES_BY_EXTENSION, CHUNK_SIZE, process_image
+from approot.data_managers.cache import catalog_version
+
+# Kept outside the web root, it lists every image. Relative paths are relative to the server root
+MANIFEST = SERVER_ROOT / config.get_optional_config('Images').get('rebuildManifest', 'config/image_manifest.json')
+LEGACY_MANIFEST = UPLOAD_FOLDER / '.manifest.json'  # Served publicly, moved to MANIFEST by the next rebuild
+MANIFEST_VERSION = 1
+SAVE_INTERVAL = 10.0  # Seconds between manifest writes, an interrupted rebuild resumes from the last one
+
+
+def settings_key() -> str:
+    """
+    Gets a digest of the settings the derivatives depend on, images processed with other settings are rebuilt
+    :return: Hex digest
+    """
+    settings = [MANIFEST_VERSION, WIDTHS, QUALITY, WEBP_QUALITY, WEBP, THUMBNAIL_SIZE, ORIGINAL_SIZE, MAX_ORIGINAL_BYTES]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()[:16]
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest() -> dict:
+    try:
+        manifest = json.loads((MANIFEST if MANIFEST.exists() else LEGACY_MANIFEST).read_text())
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(manifest: dict):
+    MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+    temp = MANIFEST.with_name(f"{MANIFEST.name}.{os.getpid()}.tmp")
+    temp.write_text(json.dumps(manifest, separators=(',', ':'), sort_keys=True))
+    os.replace(temp, MANIFEST)
+    LEGACY_MANIFEST.unlink(missing_ok=True)
+
+
+def _entry(path: Path, settings: str) -> dict:
+    stat = path.stat()
+    return {'source': file_digest(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'settings': settings}
+
+
+def is_current(path: Path, entry: dict | None, settings: str) -> bool:
+    """
+    Checks whether the derivatives of an image are up to date. The source is only hashed again when its size or
+    modification time changed
+    """
+    if not entry or entry.get('settings') != settings or not (COMPRESSED_FOLDER / path.name).is_file():
+        return False
+    stat = path.stat()
+    if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime_ns:
+        return True
+    return entry.get('source') == file_digest(path)
+
+
+def remove_stale_widths():
+    """
+    Removes the copies in widths which are no longer configured. Only once the catalog version was bumped: until then
+    the web processes serve srcsets pointing at them
+    """
+    for folder in UPLOAD_FOLDER.glob('w*'):
+        if folder.is_dir() and folder.name[1:].isdigit() and int(folder.name[1:]) not in WIDTHS:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def rebuild_one(filename: str, settings: str) -> (str, int, dict):
+    """
+    Rebuilds the derivatives of one image. Runs in a worker process
+    :return: The filename, the bytes read and the manifest entry of the image
+    """
+    process_image(filename)
+    path = UPLOAD_FOLDER / filename
+    return filename, path.stat().st_size, _entry(path, settings)
+
+
+def rebuild_images(workers: int = None, force: bool = False) -> (int, int, int):
+    """
+    Rebuilds the derivatives of the new and changed images
+    :param int workers: Worker processes, defaults to the number of CPUs
+    :param bool force: Rebuild every image
+    :return: Number of images rebuilt, skipped and failed
+    """
+    if not UPLOAD_FOLDER.is_dir():
+        print(f"{UPLOAD_FOLDER} does not exist, no images to rebuild")
+        return 0, 0, 0
+
+    settings = settings_key()
+    manifest = load_manifest()
+    images = sorted(path for path in UPLOAD_FOLDER.glob('*') if path.is_file() and not path.name.startswith('.')
+                    and path.suffix[1:].lower() in MIME_TYPES_BY_EXTENSION)
+    # Forget the images which were removed
+    names = {path.name for path in images}
+    manifest = {name: entry for name, entry in manifest.items() if name in names}
+
+    pending = [path.name for path in images if force or not is_current(path, manifest.get(path.name), settings)]
+    skipped = len(images) - len(pending)
+    print(f"{len(images)} images, {len(pending)} to rebuild, {skipped} up to date")
+    if not pending:
+        save_manifest(manifest)
+        return 0, skipped, 0
+
+    rebuilt = failed = read = 0
+    started = saved = last_report = time.monotonic()
+    # spawn: the workers only need the image settings, not a copy of this process
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(rebuild_one, filename, settings): filename for filename in pending}
+        for future in as_completed(futures):
+            try:
+                filename, size, entry = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{futures[future]}: {e}", file=sys.stderr)
+            else:
+                rebuilt += 1
+                read += size
+                manifest[filename] = entry
+
+            now = time.monotonic()
+            if now - saved >= SAVE_INTERVAL:
+                save_manifest(manifest)
+                saved = now
+            done = rebuilt + failed
+            if now - last_report >= 1.0 or done == len(pending):
+                elapsed = max(now - started, 1e-9)
+                eta = (len(pending) - done) * elapsed / done
+                print(f"[{done}/{len(pending)}] {done / elapsed:.1f} images/s, {read / elapsed / 2 ** 20:.1f} MiB/s, "
+                      f"{failed} failed, ETA {eta:.0f} s")
+                last_report = now
+
+    save_manifest(manifest)
+    if rebuilt:
+        catalog_version.bump()  # The thumbnail and images of the products changed
+    remove_stale_widths()
+    elapsed = time.monotonic() - started
+    print(f"Rebuilt {rebuilt} images in {elapsed:.1f} s ({rebuilt / max(elapsed, 1e-9):.1f} images/s), "
+          f"{skipped} up to date, {failed} failed")
+    return rebuilt, skipped, failed
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Rebuilds the thumbnails and resized copies of the product images')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to the number of CPUs')
+    parser.add_argument('--force', action='store_true', help='Rebuild images which are up to date')
+    args = parser.parse_args(argv)
+
+    _, _, failed = rebuild_images(args.workers, args.force)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
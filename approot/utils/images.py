@@ -0,0 +1,515 @@
+"""
+Product image processing.
+
+Uploads are stored by the request under the SHA-256 of their bytes, so identical uploads share one file and its
+derivatives. Only uploads larger than MAX_ORIGINAL_BYTES are decoded by the request, they are downscaled before they are
+named. The derivatives (the thumbnail and a resized copy per configured width in the format of the original and in WebP)
+are generated by a pool of worker processes so decoding never blocks a request thread.
+"""
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import requests
+import urllib3
+from PIL import Image, features
+from requests.adapters import HTTPAdapter
+
+from approot import SERVER_ROOT
+from approot.data_managers.cache import QueryCache, catalog_version
+from approot.data_managers.errors import InvalidActionError
+from approot.importer import config
+from approot.metrics import registry
+
+UPLOAD_FOLDER = SERVER_ROOT / 'webroot/static/images/products'
+COMPRESSED_FOLDER = SERVER_ROOT / 'webroot/static/images/products/compressed'
+SERVER_URL_ROOT = '/images/products'
+MAX_ORIGINAL_BYTES = 10000000  # Larger uploads are downscaled to ORIGINAL_SIZE
+ORIGINAL_SIZE = (1280, 1280)
+THUMBNAIL_SIZE = (128, 128)
+MAX_TRACKED_JOBS = 1000
+MAX_KNOWN_IMAGES = 10000  # Images whose thumbnail or resized copies are remembered by each process
+# Seconds after which a job of another process, with neither a thumbnail nor a failure marker, is reported as unknown.
+# Its worker may have died
+JOB_TIMEOUT = 600.0
+CHUNK_SIZE = 64 * 1024
+EXTENSIONS_BY_MIME_TYPE = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif'}
+MIME_TYPES_BY_EXTENSION = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'gif': 'image/gif'}
+
+_images_config = config.get_optional_config('Images')
+# Widths of the resized copies, each one is stored in UPLOAD_FOLDER/w<width>/ in the format of the original and in WebP
+WIDTHS = tuple(sorted({int(width) for width in _images_config.get('widths', '128,256,512,1280').split(',')
+                       if width.strip()}))
+QUALITY = int(_images_config.get('quality', '80'))
+WEBP_QUALITY = int(_images_config.get('webpQuality', '75'))
+WEBP = features.check('webp')
+# Seconds an unused original is kept after its last upload, its product may not be committed yet
+GC_GRACE_PERIOD = float(_images_config.get('gcGracePeriod', '86400'))
+
+image_jobs = registry.counter('flowers_image_jobs_total', 'Image jobs by final status', ('status',))
+image_job_duration = registry.histogram('flowers_image_job_duration_seconds',
+                                        'Time from enqueuing an image job to its end',
+                                        buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+def save_atomic(image: Image.Image, target: Path, **params):
+    """
+    Saves an image next to the target and renames it over the target, so readers never see a partial file
+    """
+    temp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    try:
+        image.save(temp, format=Image.registered_extensions()[target.suffix.lower()], **params)
+        os.replace(temp, target)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+def _downscale(path: Path, mimetype: str) -> str:
+    """
+    Downscales an oversized upload in place to fit ORIGINAL_SIZE
+    :param path: Temporary file of the upload
+    :param mimetype: Mimetype of the upload, one of EXTENSIONS_BY_MIME_TYPE
+    :return: Hex SHA-256 of the downscaled bytes
+    :raises InvalidActionError: If the upload is not a valid image
+    """
+    buffer = io.BytesIO()
+    try:
+        with Image.open(path) as image:
+            image.thumbnail(ORIGINAL_SIZE)
+            image.save(buffer, format=Image.registered_extensions()[f".{EXTENSIONS_BY_MIME_TYPE[mimetype]}"],
+                       optimize=True, quality=50)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise InvalidActionError(f"The image cannot be decoded: {type(e).__name__}")
+    path.write_bytes(buffer.getvalue())
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+def store_original(chunks: Iterable[bytes], mimetype: str) -> (str, bool):
+    """
+    Stores an upload under the SHA-256 of its bytes. The bytes are hashed while they are written to a temporary file,
+    which is renamed to its final name unless an identical upload is stored already. Uploads larger than
+    MAX_ORIGINAL_BYTES are downscaled first and named after the downscaled bytes, the bytes served under a name always
+    match it
+    :param chunks: Bytes of the upload
+    :param mimetype: Mimetype of the upload, one of EXTENSIONS_BY_MIME_TYPE
+    :return: The filename and whether the file is new
+    :raises InvalidActionError: If an oversized upload is not a valid image
+    """
+    UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    descriptor, temp = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix='.upload-', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            for chunk in chunks:
+                digest.update(chunk)
+                file.write(chunk)
+            size = file.tell()
+
+        name = digest.hexdigest() if size <= MAX_ORIGINAL_BYTES else _downscale(Path(temp), mimetype)
+        filename = f"{name}.{EXTENSIONS_BY_MIME_TYPE[mimetype]}"
+        target = UPLOAD_FOLDER / filename
+        if target.exists():
+            os.utime(target)  # Starts the grace period of the image GC again, the new product is not committed yet
+            return filename, False
+        os.replace(temp, target)
+        return filename, True
+    finally:
+        Path(temp).unlink(missing_ok=True)
+
+
+def derivative_path(filename: str, width: int, extension: str = None) -> Path:
+    """
+    Gets the path of a resized copy of an image
+    :param filename: Name of the original in UPLOAD_FOLDER
+    :param width: Width of the copy
+    :param extension: Extension of the copy, defaults to the extension of the original
+    :return: The path
+    """
+    if extension is not None:
+        filename = f"{filename.rsplit('.', 1)[0]}.{extension}"
+    return UPLOAD_FOLDER / f"w{width}" / filename
+
+
+def _save_widths(image: Image.Image, filename: str):
+    """
+    Saves a resized copy of the image for every configured width smaller than the image. JPEGs are decoded at the
+    smallest DCT scale still larger than the largest copy (draft), then every copy is reduced from the next larger one
+    """
+    widths = [width for width in WIDTHS if width < image.width]
+    if not widths:
+        return
+    aspect = image.height / image.width
+    if image.format == 'JPEG':
+        image.draft('RGB', (widths[-1], round(widths[-1] * aspect)))
+
+    # Resampling needs a true color image, JPEGs have no transparency
+    transparent = image.mode in ('RGBA', 'LA', 'P', 'PA') and image.format != 'JPEG'
+    frame = image.convert('RGBA' if transparent else 'RGB')
+    for width in reversed(widths):
+        frame = frame.resize((width, max(1, round(width * aspect))), Image.LANCZOS, reducing_gap=3.0)
+        target = derivative_path(filename, width)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        save_atomic(frame, target, optimize=True, quality=QUALITY)
+        if WEBP:
+            save_atomic(frame, derivative_path(filename, width, 'webp'), quality=WEBP_QUALITY, method=4)
+
+
+def failure_marker(filename: str) -> Path:
+    """
+    Gets the path of the file recording why the image job of an image failed, for the status of the other processes
+    :param filename: Name of the original in UPLOAD_FOLDER
+    :return: The path, which may not exist
+    """
+    return UPLOAD_FOLDER / f".{filename}.failed"
+
+
+def process_image(filename: str) -> str:
+    """
+    Generates the derivatives of an uploaded image. Runs in a worker process. The thumbnail is written last, its
+    existence tells that all the derivatives of the image exist
+    :param filename: Name of the original in UPLOAD_FOLDER
+    :return: The filename
+    """
+    source = UPLOAD_FOLDER / filename
+    with Image.open(source) as image:
+        _save_widths(image, filename)
+
+    # Save a low-res version of the image for thumbnails
+    COMPRESSED_FOLDER.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        save_atomic(image, COMPRESSED_FOLDER / filename, optimize=True, quality=50)
+    return filename
+
+
+class ImageJob:
+    """
+    Derivative generation of one uploaded image. The job id is the filename of the original
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished
+        }
+
+
+class ImageJobQueue:
+    """
+    Queue of image jobs processed by a ProcessPoolExecutor. The pool is created on the first job, after the server
+    forked its workers. With 0 workers the jobs run in the calling thread.
+    Jobs are tracked in the process which queued them, the last MAX_TRACKED_JOBS are kept for the status endpoint
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process with running threads and open database sockets is not safe
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, filename: str, on_done=None) -> ImageJob:
+        """
+        Queues the derivative generation of an uploaded image
+        :param filename: Name of the original in UPLOAD_FOLDER
+        :param on_done: Optional function called without arguments once the derivatives exist
+        :return: The job
+        """
+        job = ImageJob(filename)
+        failure_marker(filename).unlink(missing_ok=True)  # Tried again
+        with self._lock:
+            self._jobs[filename] = job
+            self._jobs.move_to_end(filename)
+            while len(self._jobs) > MAX_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+
+        if self.workers <= 0:
+            job.status = 'running'
+            try:
+                process_image(filename)
+            except Exception as e:
+                self._finish(job, e, on_done)
+                raise e
+            self._finish(job, None, on_done)
+            return job
+
+        try:
+            future = self._get_executor().submit(process_image, filename)
+        except BrokenProcessPool as e:
+            logging.error(f"Image worker pool is broken, creating a new one: {e}")
+            with self._lock:
+                self._executor = None
+            future = self._get_executor().submit(process_image, filename)
+        job.status = 'running' if future.running() else 'queued'
+        future.add_done_callback(lambda done: self._finish(job, done.exception(), on_done))
+        return job
+
+    @staticmethod
+    def _finish(job: ImageJob, error, on_done):
+        job.finished = time.time()
+        image_job_duration.observe(job.finished - job.created)
+        if error is not None:
+            logging.error(f"Image job {job.job_id} failed: {error}")
+            job.status = 'failed'
+            job.error = str(error)
+            try:
+                failure_marker(job.job_id).write_text(job.error)
+            except OSError as e:
+                logging.error(f"Failed to record the failure of image job {job.job_id}: {e}")
+        else:
+            job.status = 'done'
+            if on_done is not None:
+                try:
+                    on_done()
+                except Exception as e:
+                    logging.error(f"Image job {job.job_id} callback failed: {e}")
+        image_jobs.inc(status=job.status)
+
+    def get(self, job_id: str) -> ImageJob | None:
+        """
+        Gets a job. Jobs queued by another worker process are reported from the files on disk: done once the thumbnail
+        exists, failed if a failure marker exists, otherwise running, or unknown after JOB_TIMEOUT
+        :param job_id: Filename of the original
+        :return: The job or None if there is no such image
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        source = UPLOAD_FOLDER / job_id
+        if '/' in job_id or job_id.startswith('.') or not source.is_file():
+            return None
+        job = ImageJob(job_id)
+        if (COMPRESSED_FOLDER / job_id).is_file():
+            job.status = 'done'
+            return job
+        try:
+            job.error = failure_marker(job_id).read_text()
+            job.status = 'failed'
+        except FileNotFoundError:
+            # Uploads of the image refresh the modification time of the original
+            job.status = 'running' if time.time() - source.stat().st_mtime < JOB_TIMEOUT else 'unknown'
+        return job
+
+
+class RemoteImageFetcher:
+    """
+    Downloads remote images through one pooled requests.Session per process. The body is streamed in chunks of
+    CHUNK_SIZE and the download is aborted once it exceeds max_bytes or takes longer than total_timeout, so the memory
+    used by a download does not depend on the size of the remote file
+    """
+
+    def __init__(self, max_bytes: int, connect_timeout: float, read_timeout: float, total_timeout: float,
+                 pool_size: int):
+        """
+        :param int max_bytes: Largest accepted image
+        :param float connect_timeout: Seconds to wait for the connection
+        :param float read_timeout: Seconds to wait for each read from the connection
+        :param float total_timeout: Seconds the whole download may take
+        :param int pool_size: Connections kept per remote host
+        """
+        self.max_bytes = max_bytes
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            # A forked worker must not share the sockets of its parent
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    @contextmanager
+    def open(self, url: str) -> Iterator[tuple[str, Iterator[bytes]]]:
+        """
+        Starts downloading an image. The connection is returned to the pool when the context exits
+        :param url: URL of the image
+        :return: Context manager of the mimetype and an iterator of the bytes of the image
+        :raises InvalidActionError: If the image cannot be downloaded or is too large
+        """
+        try:
+            response = self._get_session().get(url, stream=True, timeout=(self.connect_timeout, self.read_timeout))
+        except requests.RequestException as e:
+            raise InvalidActionError(f"Failed to download the image: {e}")
+
+        with response:
+            if not response.ok:
+                raise InvalidActionError(f"Failed to download the image: HTTP {response.status_code}")
+            length = response.headers.get('content-length', '')
+            if length.isdigit() and int(length) > self.max_bytes:
+                raise InvalidActionError(f"The image is larger than {self.max_bytes} bytes")
+            mimetype = response.headers.get('content-type', '').split(';', 1)[0].strip()
+            yield mimetype, self._chunks(response)
+
+    def _chunks(self, response: requests.Response) -> Iterator[bytes]:
+        """
+        Reads the body. Every read is a single read from the socket, whose timeout is shrunk to the time left before
+        the deadline, so a body trickling in cannot outlast total_timeout
+        """
+        received = 0
+        deadline = time.monotonic() + self.total_timeout
+        connection = response.raw.connection
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise InvalidActionError(f"Downloading the image took longer than {self.total_timeout} seconds")
+                if connection is not None and connection.sock is not None:
+                    connection.sock.settimeout(min(self.read_timeout, remaining))
+                chunk = response.raw.read1(CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    return
+                received += len(chunk)
+                if received > self.max_bytes:
+                    raise InvalidActionError(f"The image is larger than {self.max_bytes} bytes")
+                yield chunk
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            if time.monotonic() >= deadline:
+                raise InvalidActionError(f"Downloading the image took longer than {self.total_timeout} seconds")
+            raise InvalidActionError(f"Failed to download the image: {e}")
+
+
+def create_queue_from_config() -> ImageJobQueue:
+    """
+    Creates the job queue with the settings of the [Images] section of config.ini
+    :return: ImageJobQueue
+    """
+    images_config = config.get_optional_config('Images')
+    return ImageJobQueue(int(images_config.get('workers', '2')))
+
+
+def create_fetcher_from_config() -> RemoteImageFetcher:
+    """
+    Creates the remote image fetcher with the settings of the [Images] section of config.ini
+    :return: RemoteImageFetcher
+    """
+    images_config = config.get_optional_config('Images')
+    return RemoteImageFetcher(max_bytes=int(images_config.get('maxDownloadBytes', '25000000')),
+                              connect_timeout=float(images_config.get('connectTimeout', '3')),
+                              read_timeout=float(images_config.get('readTimeout', '10')),
+                              total_timeout=float(images_config.get('downloadTimeout', '30')),
+                              pool_size=int(images_config.get('httpPoolSize', '10')))
+
+
+image_queue = create_queue_from_config()
+image_fetcher = create_fetcher_from_config()
+_thumbnails = QueryCache(max_size=MAX_KNOWN_IMAGES, ttl=float('inf'))  # Filenames whose thumbnail is known to exist
+# Filename to the srcsets of its resized copies. Dropped when the catalog version changes, which the image jobs and
+# the rebuild bump once they wrote or removed copies
+_srcsets = QueryCache(max_size=MAX_KNOWN_IMAGES, ttl=float('inf'), version=catalog_version.current)
+
+
+def image_filename(location: str | None) -> str | None:
+    """
+    Gets the filename of an uploaded image from its server URL, which is also the id of its image job
+    :param location: Server URL of the image
+    :return: The filename or None if the location is not an uploaded image
+    """
+    if not location or not location.startswith(SERVER_URL_ROOT + '/'):
+        return None
+    return location.rsplit('/', 1)[1]
+
+
+def thumbnail_url(location: str | None) -> str | None:
+    """
+    Gets the URL of the thumbnail of an image. Falls back to the image itself until its thumbnail has been generated
+    :param location: Server URL of the image
+    :return: Server URL of the thumbnail or location
+    """
+    filename = image_filename(location)
+    if filename is None:
+        return location
+    if _thumbnails.get(filename) is not True:
+        if not (COMPRESSED_FOLDER / filename).is_file():
+            return location
+        _thumbnails.set(filename, True)
+    return f"{SERVER_URL_ROOT}/compressed/{filename}"
+
+
+def image_srcsets(location: str | None) -> dict[str, str]:
+    """
+    Gets the resized copies of an image as srcset attributes by mimetype, e.g.
+    {"image/webp": "/images/products/w128/<digest>.webp 128w, ...", "image/jpeg": "..."}.
+    Empty until the image job is done and for images which are smaller than every width
+    :param location: Server URL of the image
+    :return: dict of mimetype to srcset
+    """
+    filename = image_filename(location)
+    if filename is None:
+        return {}
+    srcsets = _srcsets.get(filename)
+    if isinstance(srcsets, dict):  # Not a miss
+        return srcsets
+    if not (COMPRESSED_FOLDER / filename).is_file():
+        return {}  # Not processed yet
+
+    stem, extension = filename.rsplit('.', 1)
+    srcsets = {}
+    for mimetype, copy_extension in (('image/webp', 'webp'), (MIME_TYPES_BY_EXTENSION.get(extension.lower()), None)):
+        widths = [width for width in WIDTHS if derivative_path(filename, width, copy_extension).is_file()]
+        if mimetype and widths:
+            name = f"{stem}.{copy_extension or extension}"
+            srcsets[mimetype] = ', '.join(f"{SERVER_URL_ROOT}/w{width}/{name} {width}w" for width in widths)
+    if srcsets:
+        _srcsets.set(filename, srcsets)  # Copies written later, e.g. by a rebuild, are found next time
+    return srcsets
+
+
+def derivative_paths(filename: str) -> list[Path]:
+    """
+    Gets the paths of all the derivatives an image may have
+    :param filename: Filename of the original
+    :return: list of paths, which may not exist
+    """
+    paths = [COMPRESSED_FOLDER / filename, failure_marker(filename)]
+    for width in WIDTHS:
+        paths += [derivative_path(filename, width), derivative_path(filename, width, 'webp')]
+    paths += COMPRESSED_FOLDER.glob(f"*x*/{filename}")  # Resized on demand
+    return paths
+
+
+def forget_image(filename: str):
+    """
+    Forgets what is known about the derivatives of a removed image
+    :param filename: Filename of the original
+    :return: None
+    """
+    _thumbnails.delete(filename)
+    _srcsets.delete(filename)
@@ -0,0 +1,202 @@
+"""
+Product images resized on demand.
+
+GET /images/products/<width>x<height>/<file> resizes the original to fit the box on the first request and serves the
+stored copy from then on. Only the sizes of the allow-list are served, and the copies are kept within a total size,
+evicting the least recently used ones.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from PIL import Image
+
+from approot.importer import config
+from approot.metrics import registry
+from approot.utils.images import UPLOAD_FOLDER, COMPRESSED_FOLDER, QUALITY, MIME_TYPES_BY_EXTENSION, save_atomic
+
+TOUCH_INTERVAL = 60.0  # Seconds, a hit refreshes the modification time used as LRU order at most this often
+LOW_WATERMARK = 0.9  # Eviction frees space down to this fraction of the budget, so it does not run on every miss
+RESCAN_INTERVAL = 60.0  # Seconds, the total is read from disk again at least this often, other processes add copies too
+
+resized_images = registry.counter('flowers_resized_images_total', 'Requests of resized images by result', ('result',))
+resized_evictions = registry.counter('flowers_resized_image_evictions_total', 'Resized images evicted from disk')
+
+
+class ResizedImageCache:
+    """
+    Resized copies of the originals in UPLOAD_FOLDER, stored in <folder>/<width>x<height>/<file>.
+    Concurrent misses of the same copy in a process decode the original once, the others wait for its copy.
+    The modification time of a copy is its last use, so every worker process shares the LRU order on disk. Each
+    process adds its own copies to the total it read from disk, it misses the copies of the others, so the folder is
+    scanned again every RESCAN_INTERVAL and on every miss once the total is above LOW_WATERMARK of the budget
+    """
+
+    def __init__(self, folder: Path, sizes: set[tuple[int, int]], max_bytes: int):
+        """
+        :param Path folder: Folder of the copies
+        :param set sizes: Allowed (width, height) boxes
+        :param int max_bytes: Total size of the copies
+        """
+        self.folder = folder
+        self.sizes = sizes
+        self.max_bytes = max_bytes
+        self._total = None
+        self._scanned = 0.0  # time.monotonic() of the last scan
+        self._flights = {}  # Path of a copy being rendered to [lock, waiting threads]
+        self._lock = threading.Lock()
+
+    @property
+    def total(self) -> int:
+        return self._total or 0
+
+    def get(self, width: int, height: int, filename: str) -> Path | None:
+        """
+        Gets the copy of an image resized to fit the box, rendering it first if needed
+        :param int width: Width of the box
+        :param int height: Height of the box
+        :param str filename: Name of the original in UPLOAD_FOLDER
+        :return: Path of the copy or None if the size is not allowed or there is no such image
+        """
+        if (width, height) not in self.sizes or '/' in filename or '\\' in filename or filename.startswith('.') \
+                or filename.rsplit('.', 1)[-1].lower() not in MIME_TYPES_BY_EXTENSION:
+            return None
+        target = self.folder / f"{width}x{height}" / filename
+        if self._touch(target):
+            resized_images.inc(result='hit')
+            return target
+
+        source = UPLOAD_FOLDER / filename
+        if not source.is_file():
+            return None
+        with self._single_flight(target):
+            if self._touch(target):
+                resized_images.inc(result='wait')  # Rendered by a concurrent request
+                return target
+            started = time.perf_counter()
+            self._render(source, target, (width, height))
+            resized_images.inc(result='miss')
+            logging.debug(f"Resized {filename} to {width}x{height} in {(time.perf_counter() - started) * 1000:.0f} ms")
+        self._add(target)
+        return target
+
+    @staticmethod
+    def _touch(target: Path) -> bool:
+        """
+        Marks a copy as used
+        :return: Whether the copy exists
+        """
+        try:
+            modified = target.stat().st_mtime
+            if time.time() - modified > TOUCH_INTERVAL:
+                os.utime(target)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def _single_flight(self, target: Path):
+        with self._lock:
+            flight = self._flights.setdefault(target, [threading.Lock(), 0])
+            flight[1] += 1
+        try:
+            with flight[0]:
+                yield
+        finally:
+            with self._lock:
+                flight[1] -= 1
+                if not flight[1]:
+                    del self._flights[target]
+
+    @staticmethod
+    def _render(source: Path, target: Path, size: tuple[int, int]):
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with Image.open(source) as image:
+            image.thumbnail(size)  # Uses draft for JPEGs, only the needed DCT scale is decoded
+            save_atomic(image, target, optimize=True, quality=QUALITY)
+
+    def _add(self, target: Path):
+        added = target.stat().st_size
+        with self._lock:
+            if self._total is None or self._total + added > self.max_bytes * LOW_WATERMARK \
+                    or time.monotonic() - self._scanned >= RESCAN_INTERVAL:
+                self._total = sum(size for _, size, _ in self._scan())
+                self._scanned = time.monotonic()
+            else:
+                self._total += added
+            if self._total <= self.max_bytes:
+                return
+        self.evict(keep=target)
+
+    def _scan(self) -> list[tuple[float, int, Path]]:
+        """
+        :return: Modification time, size and path of every copy
+        """
+        copies = []
+        for path in self.folder.glob('*x*/*'):
+            if path.name.startswith('.'):
+                continue  # Being written
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            copies.append((stat.st_mtime, stat.st_size, path))
+        return copies
+
+    def evict(self, keep: Path = None):
+        """
+        Removes the least recently used copies until they fit in LOW_WATERMARK of the budget
+        :param Path keep: Copy which is not removed, the one about to be served
+        :return: None
+        """
+        copies = sorted(self._scan())
+        total = sum(size for _, size, _ in copies)
+        evicted = 0
+        for _, size, path in copies:
+            if total <= self.max_bytes * LOW_WATERMARK:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._total = total
+            self._scanned = time.monotonic()
+        if evicted:
+            resized_evictions.inc(evicted)
+            logging.info(f"Evicted {evicted} resized images, {total} bytes left")
+
+
+def parse_sizes(value: str) -> set[tuple[int, int]]:
+    """
+    Parses a list of sizes like "128x128,256x256"
+    :param value: Comma separated <width>x<height>
+    :return: set of (width, height)
+    """
+    sizes = set()
+    for size in value.split(','):
+        if size.strip():
+            width, height = size.lower().split('x')
+            sizes.add((int(width), int(height)))
+    return sizes
+
+
+def create_cache_from_config() -> ResizedImageCache:
+    """
+    Creates the cache with the settings of the [Images] section of config.ini
+    :return: ResizedImageCache
+    """
+    images_config = config.get_optional_config('Images')
+    return ResizedImageCache(COMPRESSED_FOLDER,
+                             sizes=parse_sizes(images_config.get('resizedSizes', '128x128,256x256,512x512,1024x1024')),
+                             max_bytes=int(images_config.get('resizedCacheBytes', '1000000000')))
+
+
+resized_cache = create_cache_from_config()
+
+registry.callback('flowers_resized_images_bytes', 'Size of the resized images known to this process',
+                  lambda: {(): resized_cache.total})
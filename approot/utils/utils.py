@@ -1,43 +1,41 @@
+import base64
+import binascii
 import logging
-from functools import wraps
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from functools import wraps, lru_cache
+from json.encoder import encode_basestring_ascii
 
 import mariadb
 import werkzeug.exceptions
 import werkzeug.datastructures
-from flask import jsonify, request
+from flask import Response, request, make_response
 import json
-import requests
-from werkzeug.utils import secure_filename
 
-from approot import SERVER_ROOT
-from approot.crypto.crypto import hash_key
+from approot.compression import etag_variants
 from approot.sessions import get_session
 
-from approot.data_managers.errors import InvalidActionError, InvalidMimetypeError, NotFoundError
+from approot.data_managers.cache import catalog_version
+from approot.data_managers.errors import InvalidActionError, InvalidMimetypeError, NotFoundError, \
+    ServiceUnavailableError
 from approot.database import models
+from approot.database.database import read_from_primary_after
 from approot.database.database_manager import database_transaction_helper
-from PIL import Image
+from approot.importer import config
+from approot.utils.images import UPLOAD_FOLDER, COMPRESSED_FOLDER, SERVER_URL_ROOT, CHUNK_SIZE, image_queue, \
+    image_fetcher, derivative_paths, forget_image, store_original, GC_GRACE_PERIOD
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard json module is used without it
+    orjson = None
 
-UPLOAD_FOLDER = SERVER_ROOT / 'webroot/static/images/products'
-COMPRESSED_FOLDER = SERVER_ROOT / 'webroot/static/images/products/compressed'
-SERVER_URL_ROOT = '/images/products'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif'}
 
 
-def generate_unique_filename(filename: str) -> str:
-    """
-    Generates a unique filename for a file It will keep hashing the filename until it is unique
-    :param filename: Name of the file to generate a unique filename for
-    :return: A unique filename
-    """
-    filename = f"{hash_key(filename)}.{filename.rsplit('.', 1)[1].lower()}"
-    if (UPLOAD_FOLDER / filename).exists():
-        return generate_unique_filename(filename)
-    else:
-        return filename
-
-
 def allowed_file(filename: str) -> bool:
     """
     Checks if a file is allowed to be uploaded
@@ -48,110 +46,106 @@ def allowed_file(filename: str) -> bool:
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def store_image(chunks, mimetype: str) -> str:
+    """
+    Stores an uploaded image and queues its derivatives, unless an identical image is stored already
+    :param chunks: Iterable of the bytes of the image
+    :param mimetype: Mimetype of the image
+    :return: Server URL of the image
+    """
+    filename, created = store_original(chunks, mimetype)
+    if created or not (COMPRESSED_FOLDER / filename).is_file():
+        # The catalog responses change once the thumbnail exists
+        image_queue.submit(filename, on_done=catalog_version.bump)
+    else:
+        logging.debug(f"Image {filename} is stored already")
+    return f"{SERVER_URL_ROOT}/{filename}"
+
+
 def save_image_to_disk_by_url(url: str) -> str | None:
     """
-    Saves an image to disk
+    Downloads an image to disk. The body is streamed to a temporary file, at most [Images] maxDownloadBytes are read.
+    The derivatives are generated in the background by image_queue
     :param url: URL of the image to save
     :return: Path to the saved image
+    :raises InvalidActionError: If the image cannot be downloaded or is too large
     """
     if url:
         logging.debug(f"URL: {url}")
-        response = requests.get(url)
-        mimetype = response.headers.get('content-type')
-        logging.debug(f"Mimetype: {mimetype}")
-        if mimetype.strip() in ALLOWED_MIME_TYPES:
-            logging.debug(f"Saving image to disk. Size: {len(response.content)} bytes")
-            filename = secure_filename(generate_unique_filename(response.url.rsplit('/', 1)[1]))
-            filepath = UPLOAD_FOLDER / filename
-
-            if len(response.content) > 10000000:  # Compress image to fit within 10MB
-                image = Image.open(response.raw)
-                image.thumbnail((1280, 1280))
-                image.save(filepath, optimize=True, quality=50)
-            else:  # Save image as is
-                with open(filepath, 'wb') as f:
-                    logging.debug(f"Writing to file: {filepath}")
-                    f.write(response.content)
-
-            # Save a low res version of the image for thumbnails
-            image = Image.open(filepath)
-            image.thumbnail((128, 128))
-            image.save(COMPRESSED_FOLDER / filename, optimize=True, quality=50)
-
-            server_url = f"{SERVER_URL_ROOT}/{filename}"
-            logging.debug(f"Server URL: {server_url}")
-            return server_url
-        else:
-            raise InvalidMimetypeError(f"Invalid mimetype: {mimetype}")
+        with image_fetcher.open(url) as (mimetype, chunks):
+            logging.debug(f"Mimetype: {mimetype}")
+            if mimetype in ALLOWED_MIME_TYPES:
+                server_url = store_image(chunks, mimetype)
+                logging.debug(f"Server URL: {server_url}")
+                return server_url
+            else:
+                raise InvalidMimetypeError(f"Invalid mimetype: {mimetype}")
     else:
         return None
 
 
 def save_image_to_disk_by_file(image: werkzeug.datastructures.FileStorage) -> str | None:
     """
-    Saves an image to disk
+    Saves an image to disk. The derivatives are generated in the background by image_queue
     :param image: Image to save
     :return: Path to the saved image
     """
     if image:
         mimetype = image.mimetype
         if mimetype in ALLOWED_MIME_TYPES:
-            filename = secure_filename(generate_unique_filename(image.filename))
-            filepath = UPLOAD_FOLDER / filename
-
-            if image.content_length > 10000000:  # Compress image to fit within 10MB
-                image = Image.open(image.stream)
-                image.thumbnail((1280, 1280))
-                image.save(filepath, optimize=True, quality=50)
-            else:  # Save image as is
-                image.save(filepath)
-
-            server_url = f"{SERVER_URL_ROOT}/{filename}"
-            # Save a low-res version of the image for thumbnails
-            image = Image.open(filepath)
-            image.thumbnail((128, 128))
-            image.save(COMPRESSED_FOLDER / filename, optimize=True, quality=50)
-
-            return server_url
+            return store_image(iter(lambda: image.stream.read(CHUNK_SIZE), b''), mimetype)
         else:
             raise InvalidMimetypeError(f"Invalid mimetype: {mimetype}")
     else:
         return None
 
 
+@database_transaction_helper(read_only=True, primary=True, dictionary=False)
+def count_image_references(image_url: str, cursor=None, database=None) -> int:
+    """
+    Counts the products using an image. Reads the primary, a lagging replica could miss a product which was just added
+    :param image_url: Server URL of the image
+    :param cursor: Database cursor to use
+    :param database: Database connection to use
+    :return: Number of products whose location is the image
+    """
+    cursor.execute("SELECT COUNT(*) FROM products WHERE location = ?", (image_url,))
+    return int(cursor.fetchone()[0])
+
+
 def remove_image_from_disk(image_url):
     """
-    Removes an image from disk
+    Removes an image from disk once no product uses it anymore. Identical uploads share one file, so call it after the
+    product which used the image was deleted or changed. An image uploaded again within GC_GRACE_PERIOD is kept, the
+    product of that upload may not be committed yet. The image GC removes it later if it stays unused
     :param image_url: Server URL of the image to remove
-    :return: None
+    :return: True if the image was removed
     """
     if image_url:
+        try:
+            references = count_image_references(image_url)
+        except mariadb.Error as e:
+            logging.error(f"Keeping {image_url}, failed to count its references: {e}")
+            return False
+        if references:
+            logging.debug(f"Keeping {image_url}, {references} products use it")
+            return False
         filename = image_url.rsplit('/', 1)[1]
         filepath = UPLOAD_FOLDER / filename
-        compressed_filepath = COMPRESSED_FOLDER / filename
-        if filepath.exists():
+        try:
+            if time.time() - filepath.stat().st_mtime < GC_GRACE_PERIOD:
+                logging.debug(f"Keeping {image_url}, it was uploaded again recently")
+                return False
             filepath.unlink()
-            if compressed_filepath.exists():
-                compressed_filepath.unlink()
-            return True
+        except FileNotFoundError:
+            return False
+        forget_image(filename)
+        for derivative in derivative_paths(filename):
+            derivative.unlink(missing_ok=True)
+        return True
     return False
 
 
-def rebuild_compressed_images():
-    """
-    Rebuilds the compressed images from the full size images
-    :return: None
-    """
-    for image in COMPRESSED_FOLDER.glob('*'):
-        image.unlink()
-
-    for image in UPLOAD_FOLDER.glob('*'):
-        if image.is_file():
-            img = Image.open(image)
-            img.thumbnail((128, 128))
-            img.save(COMPRESSED_FOLDER / image.name, optimize=True, quality=50)
-
-
 VALID_FILTERS = ['name', 'price', 'stock']
 VALID_FILTER_RULES = ['contains', 'equals', 'greater', 'less']
 FILTER_MAP = {
@@ -160,6 +154,15 @@ FILTER_MAP = {
     'stock': ['equals', 'greater', 'less', 'exists'],
 
 }
+FILTER_OPERATORS = {
+    'contains': 'LIKE ?',
+    'equals': '= ?',
+    'greater': '> ?',
+    'less': '< ?',
+    'exists': '> 0',
+}
+SEARCH_WORD = re.compile(r'\w+')
+MAX_SEARCH_WORDS = 10
 
 
 def handle_error_flask(func):
@@ -181,6 +184,8 @@ def handle_error_flask(func):
             return handle_not_found_error(e)
         except (InvalidActionError, InvalidMimetypeError) as e:
             return handle_validation_error(e)
+        except ServiceUnavailableError as e:
+            return handle_service_unavailable(e)
         except Exception as e:
             return handle_unknown_error(e)
 
@@ -209,44 +214,210 @@ def validate_key_(func):
     return wrapper
 
 
-def create_filter_query(filters: list[models.Filter]) -> str:
+def catalog_response(func):
+    """
+    Decorator for public catalog endpoints. Tags the response with the catalog version (ETag and Last-Modified)
+    and adds the Cache-Control header from the [Cache] section of config.ini.
+    If the client already has the current version (If-None-Match) a 304 is returned before the endpoint runs, so the
+    database is not queried. If-Modified-Since is ignored, Last-Modified has a resolution of a second and two writes
+    in the same second would look unchanged.
+    For read_your_writes_window seconds after a write the endpoint reads from the primary, so no replica which has not
+    caught up yet returns older rows under the new version.
+    :param func:
+    :return:
     """
-    Creates a query string based on the filters provided
+    cache_config = config.get_cache_config()
+    cache_control = f"public, max-age={int(cache_config.get('maxAge', '60'))}, " \
+                    f"stale-while-revalidate={int(cache_config.get('staleWhileRevalidate', '300'))}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        version = catalog_version.current()
+        etag = f"c{version}"
+        last_modified = datetime.fromtimestamp(version // 1_000_000_000, tz=timezone.utc)
+
+        not_modified = any(request.if_none_match.contains(tag) for tag in etag_variants(etag))
+        if not_modified:
+            response = Response(status=304)
+        else:
+            read_from_primary_after(version / 1_000_000_000)
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    return wrapper
+
+
+def compile_filter_query(filters: list[models.Filter]) -> (str, tuple):
+    """
+    Compiles the filters into a parameterized WHERE clause fragment. Values are never pasted into the SQL, so every
+    list of filters with the same shape produces the same statement text and can share a prepared statement.
     :param filters: List of filters to apply
-    :return: A string containing the query
+    :return: A string containing the query and a tuple containing the values to bind to it
+    :raises InvalidActionError: If a filter uses an invalid field or rule
     """
+    shape = []
+    params = []
+    for _filter in filters or []:
+        if _filter:
+            if _filter.field not in FILTER_MAP.keys() or _filter.rule not in FILTER_MAP[_filter.field]:
+                raise InvalidActionError(f"Invalid filter: {str(_filter)} {FILTER_MAP.get(_filter.field, [])}")
+
+            shape.append((_filter.field, _filter.rule, bool(_filter.negate), _filter.comparator))
+            if _filter.rule == 'contains':
+                params.append(f"%{escape_like(str(_filter.value))}%")
+            elif _filter.rule != 'exists':
+                params.append(_filter.value)
+    return compile_filter_template(tuple(shape)), tuple(params)
 
+
+@lru_cache(maxsize=256)
+def compile_filter_template(shape: tuple) -> str:
+    """
+    Creates the SQL template for a filter shape. Memoized since the number of distinct shapes is small
+    :param shape: tuple of (field, rule, negate, comparator) tuples. Must already be validated against FILTER_MAP
+    :return: A string containing the query with ? placeholders
+    """
     query = ""
-    for _filter in filters:
-        if _filter:
+    for field, rule, negate, comparator in shape:
+        query += f"{comparator} {'NOT ' if negate else ''}{field} {FILTER_OPERATORS[rule]} "
+    return query
+
+
+def compile_search_query(search: str | None) -> str | None:
+    """
+    Converts the words typed by a user to a FULLTEXT boolean mode query. Every word must match and the last one may be
+    incomplete since it is still being typed. Operators typed by the user are dropped
+    :param search: Words to search for
+    :return: The AGAINST expression or None if there is nothing to search for
+    """
+    words = SEARCH_WORD.findall(search or '')[:MAX_SEARCH_WORDS]
+    if not words:
+        return None
+    return ' '.join(f"+{word}" for word in words[:-1]) + ('' if len(words) == 1 else ' ') + f"+{words[-1]}*"
+
 
-            if _filter.field in FILTER_MAP.keys() and _filter.rule in FILTER_MAP[_filter.field]:
-
-                if _filter.rule == 'contains':
-                    query += f"{_filter.comparator} {'NOT' if _filter.negate else ''} {_filter.field} LIKE '%{_filter.value}%' "
-                elif _filter.rule == 'equals':
-                    query += f"{_filter.comparator} {'NOT' if _filter.negate else ''} {_filter.field} = '{_filter.value}' "
-                elif _filter.rule == 'greater':
-                    query += f"{_filter.comparator} {'NOT' if _filter.negate else ''} {_filter.field} > '{_filter.value}' "
-                elif _filter.rule == 'less':
-                    query += f"{_filter.comparator} {'NOT' if _filter.negate else ''} {_filter.field} < '{_filter.value}' "
-                elif _filter.rule == 'exists':
-                    query += f"{_filter.comparator} {'NOT' if _filter.negate else ''} {_filter.field} > '{0}' "
+def escape_like(value: str) -> str:
+    """
+    Escapes the LIKE wildcards in a value so they are matched literally
+    :param value:
+    :return:
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def encode_cursor(product: models.Product) -> str:
+    """
+    Creates an opaque pagination cursor pointing after the provided product
+    :param product: Last product of the current page
+    :return: URL safe cursor token
+    """
+    payload = json.dumps({'product_id': product.product_id}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str) -> int:
+    """
+    Decodes a pagination cursor created by encode_cursor
+    :param token: Cursor token sent by the client
+    :return: product_id to seek past
+    :raises InvalidActionError: If the cursor is malformed
+    """
+    try:
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return int(json.loads(payload)['product_id'])
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise InvalidActionError(f"Invalid cursor: '{token}'") from e
+
+
+def _json_default(obj):
+    """
+    Serializes the objects the JSON encoders do not know, like the models
+    :param obj:
+    :return:
+    """
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_json(payload) -> bytes:
+    """
+    Serializes a payload to JSON in one pass. Models (e.g. Product) can be passed as is.
+    Uses orjson when it is installed since it is several times faster than the json module
+    :param payload:
+    :return: UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATACLASS)
+    return json.dumps(payload, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+
+@lru_cache(maxsize=64)
+def row_encoder(keys: tuple):
+    """
+    Builds a JSON encoder for tuple rows whose values are in the order of keys. The keys are encoded once, only the
+    values are encoded per row, which is several times faster than json.dumps of a dict per row.
+    Strings, ints and None are encoded inline, any other value goes through json.dumps
+    :param keys: Keys of the JSON object
+    :return: Function returning the JSON object of a row as a str
+    """
+    prefixes = tuple(('{' if i == 0 else ',') + json.dumps(key) + ':' for i, key in enumerate(keys))
+
+    def encode(row: tuple) -> str:
+        parts = []
+        for prefix, value in zip(prefixes, row):
+            parts.append(prefix)
+            if value is None:
+                parts.append('null')
+            elif type(value) is str:
+                parts.append(encode_basestring_ascii(value))
+            elif type(value) is int:
+                parts.append(str(value))
             else:
-                raise InvalidActionError(f"Invalid filter: {str(_filter)} {FILTER_MAP.get(_filter.field, [])}")
-    return query
+                parts.append(json.dumps(value, default=_json_default, separators=(',', ':')))
+        parts.append('}')
+        return ''.join(parts)
+
+    return encode
+
+
+def dumps_ndjson(models: list) -> bytes:
+    """
+    Serializes models one JSON object per line. orjson encodes the models directly, without it the values of to_dict
+    are encoded by row_encoder, which encodes the keys once instead of once per model
+    :param models: Models to serialize, all of the same class
+    :return: UTF-8 encoded JSON lines, each terminated by a newline
+    """
+    if orjson is not None:
+        return b''.join([orjson.dumps(model, default=_json_default,
+                                      option=orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_APPEND_NEWLINE)
+                         for model in models])
+    if not models:
+        return b''
+    encode = row_encoder(tuple(models[0].to_dict()))
+    return ''.join([encode(tuple(model.to_dict().values())) + '\n' for model in models]).encode('utf-8')
 
 
-def success_response(message, data=None):
+def json_response(payload, status_code=200) -> (Response, int):
+    return Response(dumps_json(payload), mimetype='application/json'), status_code
+
+
+def success_response(message, data=None, **extra):
     if data is None:
         data = dict()
-    return jsonify({"status": "success", "message": message, "data": data}), 200
+    return json_response({"status": "success", "message": message, "data": data, **extra}, 200)
 
 
 def error_response(message, status_code=500, data=None):
     if data is None:
         data = dict()
-    return jsonify({"status": "error", "message": message, "data": data}), status_code
+    return json_response({"status": "error", "message": message, "data": data}, status_code)
 
 
 def handle_unauthorized():
@@ -257,6 +428,12 @@ def handle_validation_error(message):
     return error_response(f'Validation Error: {message}', 400)
 
 
+def handle_service_unavailable(exception):
+    response, status_code = error_response(f'Service Unavailable: {exception}', 503)
+    response.headers['Retry-After'] = str(exception.retry_after)
+    return response, status_code
+
+
 def handle_unknown_error(message):
     return error_response(f'Unknown Error: {message}', 500)
 
@@ -303,7 +480,7 @@ class ReviewManager:
     """
 
     @staticmethod
-    @database_transaction_helper
+    @database_transaction_helper(prepared=True, read_only=True)
     def get_all_reviews(filters=None, limit=10, offset=0, cursor=None, database=None):
         """
         Gets all reviews from the database
@@ -317,9 +494,9 @@ class ReviewManager:
         try:
             n_offset = limit * offset  # Calculate the offset based on the limit and offset provided
 
-            query = "SELECT * FROM reviews WHERE 1=1 {} LIMIT {} OFFSET {}".format(
-                create_filter_query(filters) if filters else '', limit, n_offset)
-            cursor.execute(query)
+            filter_query, params = compile_filter_query(filters)
+            query = "SELECT * FROM reviews WHERE 1=1 {} LIMIT ? OFFSET ?".format(filter_query)
+            cursor.execute(query, params + (limit, n_offset))
             data = cursor.fetchall()
 
             if not data or all(all(x for x in obj.values()) for obj in data):
@@ -334,4 +511,6 @@ class ReviewManager:
 
 
 if __name__ == "__main__":
-    rebuild_compressed_images()
+    from approot.utils.image_rebuild import main
+
+    sys.exit(main())
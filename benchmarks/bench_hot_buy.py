@@ -0,0 +1,115 @@
+"""
+Benchmark of buying one hot product with N concurrent buyers.
+
+Compares the old purchase path (SELECT ... FOR UPDATE, check in Python, UPDATE) with the single statement
+conditional decrement used by ProductManager.buy_product. Runs against the database configured in config.ini on a
+scratch table, the products table is not touched.
+
+Usage:
+    python -m benchmarks.bench_hot_buy --buyers 1 8 32 --seconds 5
+"""
+import argparse
+import threading
+import time
+
+import mariadb
+
+from approot.importer import config
+
+TABLE = "bench_hot_buy_products"
+
+
+def connect() -> mariadb.Connection:
+    database_config = config.get_database_config()
+    return mariadb.connect(host=database_config['host'],
+                           user=database_config['user'],
+                           password=database_config['password'],
+                           database=database_config['database'],
+                           port=int(database_config['port']))
+
+
+def locking_buy(connection: mariadb.Connection, cursor, product_id: int, quantity: int) -> bool:
+    """
+    The purchase path before the change. Holds the row lock across two round trips
+    """
+    cursor.execute(f"SELECT stock FROM {TABLE} WHERE product_id = ? FOR UPDATE", (product_id,))
+    stock = cursor.fetchone()[0]
+    if stock < quantity:
+        connection.rollback()
+        return False
+    cursor.execute(f"UPDATE {TABLE} SET stock = stock - ? WHERE product_id = ?", (quantity, product_id))
+    connection.commit()
+    return True
+
+
+def conditional_buy(connection: mariadb.Connection, cursor, product_id: int, quantity: int) -> bool:
+    """
+    The purchase path of ProductManager.buy_product. Checks and decrements in one statement
+    """
+    cursor.execute(f"UPDATE {TABLE} SET stock = stock - ? WHERE product_id = ? AND stock >= ?",
+                   (quantity, product_id, quantity))
+    bought = cursor.rowcount == 1
+    connection.commit()
+    return bought
+
+
+def run(buy, buyers: int, seconds: float) -> float:
+    """
+    Runs buyers threads buying product 1 until the time runs out
+    :return: Successful buys per second
+    """
+    setup = connect()
+    setup.cursor().execute(f"UPDATE {TABLE} SET stock = ? WHERE product_id = 1", (10 ** 12,))
+    setup.commit()
+    setup.close()
+
+    counts = [0] * buyers
+    start = threading.Barrier(buyers + 1)
+    deadline = []
+
+    def buyer(index: int):
+        connection = connect()
+        cursor = connection.cursor()
+        start.wait()
+        while time.perf_counter() < deadline[0]:
+            if buy(connection, cursor, 1, 1):
+                counts[index] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+    for thread in threads:
+        thread.start()
+    deadline.append(time.perf_counter() + seconds)
+    start.wait()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buyers', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    connection = connect()
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (product_id INT PRIMARY KEY, stock BIGINT NOT NULL) "
+                   f"ENGINE=InnoDB")
+    cursor.execute(f"REPLACE INTO {TABLE} (product_id, stock) VALUES (1, 0)")
+    connection.commit()
+
+    try:
+        print(f"{'buyers':>8} {'locking buys/s':>16} {'conditional buys/s':>20} {'speedup':>8}")
+        for buyers in args.buyers:
+            locking = run(locking_buy, buyers, args.seconds)
+            conditional = run(conditional_buy, buyers, args.seconds)
+            print(f"{buyers:>8} {locking:>16.0f} {conditional:>20.0f} {conditional / locking:>7.2f}x")
+    finally:
+        cursor.execute(f"DROP TABLE {TABLE}")
+        connection.commit()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
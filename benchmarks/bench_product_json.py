@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of the product list response.
+
+Compares the old get_products response (to_dict, json.dumps of the list, logged, then the JSON string wrapped in
+jsonify) with success_response serializing the Product objects once. Prints the response size and the time per page
+for pages of 10, 100 and 1000 products. Runs without a database.
+
+Usage:
+    python -m benchmarks.bench_product_json --repeat 200
+"""
+import argparse
+import json
+import timeit
+
+from flask import Flask, jsonify
+
+from approot.database.models import Product
+from approot.utils import utils
+
+
+def make_products(count: int) -> list[Product]:
+    return [Product(name=f"Bouquet {i}", price=1999 + i, description="A bunch of fresh roses " * 4, stock=i % 50,
+                    location=f"/images/products/{i:064x}.jpg", product_id=i) for i in range(count)]
+
+
+def old_response(products: list[Product]):
+    test_dump = json.dumps([product.to_dict() for product in products], separators=(',', ':'))  # Was logged
+    str(test_dump)
+    return jsonify({"status": "success", "message": "Retrieved products successfully",
+                    "data": json.dumps([product.to_dict() for product in products], separators=(',', ':'))}), 200
+
+
+def new_response(products: list[Product]):
+    return utils.success_response("Retrieved products successfully", products, cursor=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    print(f"encoder: {'orjson' if utils.orjson is not None else 'json'}")
+    print(f"{'products':>8} {'old bytes':>10} {'new bytes':>10} {'old us':>10} {'new us':>10} {'speedup':>8}")
+    with app.app_context():
+        for size in args.sizes:
+            products = make_products(size)
+            old_bytes = len(old_response(products)[0].get_data())
+            new_bytes = len(new_response(products)[0].get_data())
+            old_time = timeit.timeit(lambda: old_response(products)[0].get_data(), number=args.repeat) / args.repeat
+            new_time = timeit.timeit(lambda: new_response(products)[0].get_data(), number=args.repeat) / args.repeat
+            print(f"{size:>8} {old_bytes:>10} {new_bytes:>10} {old_time * 1e6:>10.1f} {new_time * 1e6:>10.1f} "
+                  f"{old_time / new_time:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
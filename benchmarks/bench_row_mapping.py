@@ -0,0 +1,140 @@
+"""
+Benchmark of fetching and serializing a large product result.
+
+Compares the old read path (dictionary cursor, Product.from_dict into a regular dataclass, to_dict, json) with the
+current one (tuple cursor, Product.from_rows into the slotted Product, dumps_ndjson). Prints the objects built per
+second, the time to serialize them and the peak RSS of each path. Every path runs in a process of its own so the peak
+RSS of one does not hide the other. Runs against the database configured in config.ini on a scratch table, the products
+table is not touched.
+
+Usage:
+    python -m benchmarks.bench_row_mapping --rows 100000
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+
+import mariadb
+
+from approot.database.models import Product, field_names
+from approot.importer import config
+from approot.utils import utils
+
+TABLE = "bench_row_mapping_products"
+
+
+@dataclass
+class OldProduct:
+    """
+    Product before it was slotted
+    """
+    name: str
+    price: int
+    description: str
+    stock: int
+    location: str = None
+    product_id: int = None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
+    def to_dict(self):
+        return {'name': self.name, 'price': self.price, 'description': self.description, 'stock': self.stock,
+                'location': self.location, 'product_id': self.product_id}
+
+
+def connect() -> mariadb.Connection:
+    database_config = config.get_database_config()
+    return mariadb.connect(host=database_config['host'],
+                           user=database_config['user'],
+                           password=database_config['password'],
+                           database=database_config['database'],
+                           port=int(database_config['port']))
+
+
+def old_path(cursor) -> (list, float, float):
+    started = time.perf_counter()
+    cursor.execute(f"SELECT * FROM {TABLE}")
+    products = [OldProduct.from_dict(row) for row in cursor.fetchall()]
+    fetched = time.perf_counter()
+    b''.join(json.dumps(product.to_dict(), separators=(',', ':')).encode('utf-8') + b'\n' for product in products)
+    return products, fetched - started, time.perf_counter() - fetched
+
+
+def new_path(cursor) -> (list, float, float):
+    started = time.perf_counter()
+    cursor.execute(f"SELECT * FROM {TABLE}")
+    products = Product.from_rows(cursor.fetchall(), tuple(column[0] for column in cursor.description))
+    fetched = time.perf_counter()
+    utils.dumps_ndjson(products)
+    return products, fetched - started, time.perf_counter() - fetched
+
+
+def measure(variant: str):
+    """
+    Runs one path and prints its results as JSON. Called in a child process
+    """
+    connection = connect()
+    cursor = connection.cursor(dictionary=variant == 'old')
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    products, fetch_time, serialize_time = (old_path if variant == 'old' else new_path)(cursor)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+    connection.close()
+    print(json.dumps({'rows': len(products), 'fetch': fetch_time, 'serialize': serialize_time,
+                      'rss': (peak - baseline) / 1024}))
+
+
+def populate(rows: int):
+    connection = connect()
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (product_id INT PRIMARY KEY, name VARCHAR(255), "
+                   f"price INT, description TEXT, stock INT, location VARCHAR(255)) ENGINE=InnoDB")
+    cursor.execute(f"TRUNCATE TABLE {TABLE}")
+    columns = ', '.join(field_names(Product))
+    for start in range(0, rows, 10000):
+        cursor.executemany(f"INSERT INTO {TABLE} ({columns}) VALUES (?, ?, ?, ?, ?, ?)",
+                           [(f"Bouquet {i}", 1999 + i, "A bunch of fresh roses " * 4, i % 50,
+                             f"/images/products/{i:064x}.jpg", i)
+                            for i in range(start, min(start + 10000, rows))])
+    connection.commit()
+    connection.close()
+
+
+def drop():
+    connection = connect()
+    connection.cursor().execute(f"DROP TABLE IF EXISTS {TABLE}")
+    connection.commit()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--variant', choices=['old', 'new'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        measure(args.variant)
+        return
+
+    populate(args.rows)
+    try:
+        print(f"encoder: {'orjson' if utils.orjson is not None else 'json'}")
+        print(f"{'path':>5} {'rows':>8} {'objects/s':>12} {'serialize ms':>13} {'peak RSS MiB':>13}")
+        for variant in ('old', 'new'):
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_row_mapping', '--variant', variant],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(f"{variant:>5} {result['rows']:>8} {result['rows'] / result['fetch']:>12.0f} "
+                  f"{result['serialize'] * 1000:>13.1f} {result['rss']:>13.1f}")
+    finally:
+        drop()
+
+
+if __name__ == '__main__':
+    main()
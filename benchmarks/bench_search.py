@@ -0,0 +1,99 @@
+"""
+Benchmark of the product search.
+
+Compares the old name contains filter (name LIKE '%word%', a full table scan) with the FULLTEXT search used by
+GET /api/products/?search= (MATCH ... AGAINST in boolean mode, ranked by relevance). Prints the average latency of the
+first page for a few searches typed one letter at a time. Runs against the database configured in config.ini on a
+scratch table of --rows products, the products table is not touched.
+
+Usage:
+    python -m benchmarks.bench_search --rows 100000 --repeat 20
+"""
+import argparse
+import random
+import time
+
+import mariadb
+
+from approot.importer import config
+from approot.utils.utils import compile_search_query, escape_like
+
+TABLE = "bench_search_products"
+WORDS = ['rose', 'tulip', 'lily', 'orchid', 'daisy', 'peony', 'sunflower', 'carnation', 'red', 'white', 'pink',
+         'yellow', 'bouquet', 'bunch', 'fresh', 'dried', 'wedding', 'birthday', 'spring', 'garden']
+SEARCHES = ['r', 'ro', 'ros', 'rose', 'red ros', 'white peo', 'wedding bouquet']
+
+
+def connect() -> mariadb.Connection:
+    database_config = config.get_database_config()
+    return mariadb.connect(host=database_config['host'],
+                           user=database_config['user'],
+                           password=database_config['password'],
+                           database=database_config['database'],
+                           port=int(database_config['port']))
+
+
+def like_search(cursor, search: str) -> list:
+    cursor.execute(f"SELECT * FROM {TABLE} WHERE 1=1 AND name LIKE ? ORDER BY product_id LIMIT 10 OFFSET 0",
+                   (f"%{escape_like(search)}%",))
+    return cursor.fetchall()
+
+
+def fulltext_search(cursor, search: str) -> list:
+    query = compile_search_query(search)
+    cursor.execute(f"SELECT *, MATCH(name, description) AGAINST (? IN BOOLEAN MODE) AS relevance FROM {TABLE} "
+                   f"WHERE MATCH(name, description) AGAINST (? IN BOOLEAN MODE) AND (1=1 ) "
+                   f"ORDER BY relevance DESC, product_id LIMIT 10 OFFSET 0", (query, query))
+    return cursor.fetchall()
+
+
+def timed(search_func, cursor, search: str, repeat: int) -> (float, int):
+    """
+    :return: Average seconds per search and number of results of the first page
+    """
+    results = search_func(cursor, search)  # Warm up
+    started = time.perf_counter()
+    for _ in range(repeat):
+        search_func(cursor, search)
+    return (time.perf_counter() - started) / repeat, len(results)
+
+
+def populate(cursor, rows: int):
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (product_id INT PRIMARY KEY, name VARCHAR(255), "
+                   f"price INT, description TEXT, stock INT, location VARCHAR(255)) ENGINE=InnoDB")
+    cursor.execute(f"TRUNCATE TABLE {TABLE}")
+    generator = random.Random(317)
+    for start in range(0, rows, 10000):
+        cursor.executemany(f"INSERT INTO {TABLE} (product_id, name, price, description, stock, location) "
+                           f"VALUES (?, ?, ?, ?, ?, ?)",
+                           [(i, ' '.join(generator.sample(WORDS, 3)).title(), 1999, ' '.join(generator.sample(WORDS, 8)),
+                             i % 50, None) for i in range(start, min(start + 10000, rows))])
+    cursor.execute(f"ALTER TABLE {TABLE} ADD FULLTEXT INDEX ft_name_description (name, description)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    connection = connect()
+    cursor = connection.cursor()
+    try:
+        populate(cursor, args.rows)
+        connection.commit()
+
+        print(f"{'search':>16} {'LIKE ms':>9} {'hits':>5} {'FULLTEXT ms':>12} {'hits':>5} {'speedup':>8}")
+        for search in SEARCHES:
+            like_time, like_hits = timed(like_search, cursor, search, args.repeat)
+            fulltext_time, fulltext_hits = timed(fulltext_search, cursor, search, args.repeat)
+            print(f"{search:>16} {like_time * 1000:>9.2f} {like_hits:>5} {fulltext_time * 1000:>12.2f} "
+                  f"{fulltext_hits:>5} {like_time / fulltext_time:>7.2f}x")
+    finally:
+        cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        connection.commit()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,17 @@ def get_database_config():
     return config['Database']
 
 
+def get_replica_configs():
+    """
+    Gets the configuration of every read replica from the config.ini file
+    Replicas are optional sections named DatabaseReplica followed by anything, e.g. [DatabaseReplica1]
+    Missing keys fall back to the [Database] section
+    :return: list of (section name, section) tuples
+    """
+    config = get_config(Path(__file__).parents[0] / 'config.ini')
+    return [(name, config[name]) for name in config.sections() if name.startswith('DatabaseReplica')]
+
+
 def get_flask_config():
     """
     Gets the Flask configuration from the config.ini file
@@ -32,6 +43,27 @@ def get_flask_config():
     return config['Server']
 
 
+def get_optional_config(section: str):
+    """
+    Gets an optional section from the config.ini file. Missing sections are returned empty so callers fall back
+    to their defaults
+    :param section: Name of the section
+    :return:
+    """
+    config = get_config(Path(__file__).parents[0] / 'config.ini')
+    if not config.has_section(section):
+        config.add_section(section)
+    return config[section]
+
+
+def get_cache_config():
+    """
+    Gets the query cache configuration from the config.ini file
+    :return:
+    """
+    return get_optional_config('Cache')
+
+
 def get_log_config():
     """
     Gets the logging configuration from the config.ini file
@@ -45,4 +77,5 @@ def get_log_config():
 if __name__ == '__main__':
     print(get_database_config())
     print(get_flask_config())
-    print(get_log_config())
\ No newline at end of file
+    print(get_log_config())
+    print(dict(get_cache_config()))
\ No newline at end of file